@@ -7,29 +7,44 @@ from util.schedule import create_periodic_event
 
 
 class AudioFeature(PipelineProcess):
+    shed_level = 1
 
-    def __init__(self, feature_id, audio_sources, audio_video_pair_map, window_length=10):
+    def __init__(self, feature_id, audio_sources, audio_video_pair_map, window_length=10, cache=None):
+        # With a FeatureCache over file inputs, cached loudness is replayed and the audio is not sent at all.
+        track = cache.track(AudioFeature, audio_sources,
+                            params=([source.sample_rate for source in audio_sources], 1 / 30)) if cache else None
+
+        self.replaying = track is not None and track.replaying
         super().__init__(pipeline_id=feature_id,
                          target_function=AudioFeature.establish_process_loop,
-                         params=(audio_video_pair_map, window_length),
-                         sources=audio_sources)
+                         params=(audio_video_pair_map, window_length, track),
+                         sources=[] if self.replaying else audio_sources)
 
     @staticmethod
-    def establish_process_loop(input_queue, output_queue, audio_video_pair_map, window_length):
+    def establish_process_loop(input_queue, output_queue, audio_video_pair_map, window_length, track):
         window = deque(maxlen=window_length)  # A sliding window containing the most active stream for each frame
         video_ids = set(audio_video_pair_map.values())
+        source_ids = list(audio_video_pair_map)
 
         def weight_sources():
             # Inform Python we are using vars from the outer scope.
             nonlocal window, video_ids, audio_video_pair_map
 
-            source_audio = {source_id: [] for source_id in audio_video_pair_map}
-            for update_step in get_all_from_queue(input_queue):
-                for source_id, audio_frame_list in update_step.items():
-                    source_audio[source_id] += list(itertools.chain.from_iterable(audio_frame_list))
+            # Measure the loudness of each source, or replay the cached measurement for this point in the run.
+            if track is not None and track.replaying:
+                loudness = dict(zip(source_ids, track.lookup()))
+            else:
+                source_audio = {source_id: [] for source_id in audio_video_pair_map}
+                for update_step in get_all_from_queue(input_queue):
+                    for source_id, audio_frame_list in update_step.items():
+                        source_audio[source_id] += list(itertools.chain.from_iterable(audio_frame_list))
+
+                loudness = {source_id: max(source_audio[source_id], default=0) for source_id in source_ids}
+                if track is not None:
+                    track.record([loudness[source_id] for source_id in source_ids])
 
             # Determine loudest source; append corresponding video ID to sliding window
-            max_audio_id = max(source_audio, key=lambda id: max(source_audio[id], default=0))
+            max_audio_id = max(source_ids, key=lambda id: loudness[id])
             window.append(audio_video_pair_map[max_audio_id])
 
             # Vote proportionally based on count in window
@@ -44,6 +59,9 @@ class AudioFeature(PipelineProcess):
         scheduler = create_periodic_event(interval=1 / 30, action=weight_sources)
         scheduler.run()
 
+        if track is not None:
+            track.finish()
+
 
 
 
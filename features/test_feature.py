@@ -1,21 +1,30 @@
 from util.distribution import Distribution
-from util.pipeline import PipelineProcess, get_from_queue, get_all_from_queue
+from util.pipeline import PipelineProcess, get_all_from_queue
 from util.schedule import create_periodic_event
 
 
 class TestFeature(PipelineProcess):
     """ This class serves an example of how to design a feature using the PipelineProcess class. """
 
-    def __init__(self, feature_id, audio_video_pairs, sources, interval=1/30):
+    # Features are the first work shed under load (see util.governor.LoadGovernor); their loops slow down.
+    shed_level = 1
+
+    def __init__(self, feature_id, audio_video_pairs, sources, interval=1/30, cache=None):
         """ PipelineProcess handles the behind-the-scenes setup of the subprocess. Just pass the superclass
             constructor a target static method to execute as well as the relevant parameters. """
+        # Optional: with a FeatureCache (util/feature_cache.py), per-frame measurements over file inputs are stored
+        # on the first run and replayed on later runs. Pass every parameter that affects the measurements. When
+        # replaying, the sources need not be fed to the process at all. Only runs covering the whole input are stored.
+        track = cache.track(TestFeature, sources, params=(interval,)) if cache else None
+
+        self.replaying = track is not None and track.replaying
         super().__init__(pipeline_id=feature_id,
                          target_function=TestFeature.establish_process_loop,
-                         params=(audio_video_pairs, interval),
-                         sources=sources)
+                         params=(audio_video_pairs, interval, track),
+                         sources=[] if self.replaying else sources)
 
     @staticmethod
-    def establish_process_loop(input_queue, output_queue, audio_video_pairs, interval):
+    def establish_process_loop(input_queue, output_queue, audio_video_pairs, interval, track):
         """ This function is passed to a separate python process with shared input and output queues. """
         # State variables to be reference by repeated process.
         video_ids = [pair[1] for pair in audio_video_pairs]
@@ -28,10 +37,17 @@ class TestFeature(PipelineProcess):
             # any changes.
             nonlocal video_ids
 
-            # Input data for feature calculation
-            input_data = get_all_from_queue(input_queue)
+            # Measurements for feature calculation: replayed from the cache, or calculated from the input data.
+            if track is not None and track.replaying:
+                measurements = track.lookup()
+            else:
+                input_data = get_all_from_queue(input_queue)
 
-            # Do some calculations here.
+                # Do some calculations here, producing one measurement per source.
+                measurements = [0.0 for _ in video_ids]
+
+                if track is not None:
+                    track.record(measurements)
 
             # Output vote distribution via the output_queue.
             vote = Distribution({vid_id: 0.0 for vid_id in video_ids})
@@ -41,6 +57,10 @@ class TestFeature(PipelineProcess):
         scheduler = create_periodic_event(interval=interval, action=weight_sources, action_args=())
         scheduler.run()
 
+        # Store recorded measurements once the loop has stopped.
+        if track is not None:
+            track.finish()
+
 
 
 
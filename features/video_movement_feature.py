@@ -2,6 +2,8 @@ from collections import deque, Counter
 
 import cv2
 
+from util.buffer_pool import BufferPool, resize_into
+from util.compressed_frames import decode_frame
 from util.distribution import Distribution
 from util.pipeline import PipelineProcess, get_all_from_queue
 from util.schedule import create_periodic_event
@@ -11,22 +13,37 @@ class VideoMovementFeature(PipelineProcess):
     """
     Votes for a video stream based on which stream has the most pairwise frame differences within a sliding window.
     """
+    shed_level = 1
 
-    def __init__(self, feature_id, video_sources, window_length=10):
+    def __init__(self, feature_id, video_sources, window_length=10, cache=None):
+        # With a FeatureCache over file inputs, cached motion is replayed and the frames are not sent at all. Frames
+        # decoded at reduced scale measure differently, so each file's decode mode is part of the cache key.
+        def params():
+            return (640, 480), 25, 1 / 30, [(source.compressed, source.decode_scale((640, 480)))
+                                            for source in video_sources]
+
+        track = cache.track(VideoMovementFeature, video_sources, params) if cache else None
+
+        self.replaying = track is not None and track.replaying
         super().__init__(pipeline_id=feature_id,
                          target_function=VideoMovementFeature.establish_process_loop,
-                         params=(window_length, [source.id for source in video_sources]),
-                         sources=video_sources)
+                         params=(window_length, [source.id for source in video_sources], track),
+                         sources=[] if self.replaying else video_sources)
 
     @staticmethod
-    def establish_process_loop(input_queue, output_queue, window_length, source_ids):
+    def establish_process_loop(input_queue, output_queue, window_length, source_ids, track):
         import numpy
         window = deque(maxlen=window_length)  # A sliding window containing the most active stream for each frame
-        last_frames = {source_id: numpy.zeros((480, 640, 3), dtype='uint8') for source_id in source_ids}
         width, height = 640, 480
 
-        def weight_sources():
-            nonlocal window, last_frames
+        # Resized frames and diff images are written into recycled buffers. Each frame buffer is held while it is
+        # the newest frame for its source and again while it is the last frame diffed against.
+        pool = BufferPool()
+        last_frames = {source_id: numpy.zeros((height, width, 3), dtype='uint8') for source_id in source_ids}
+        diff_buffer = numpy.zeros((height, width, 3), dtype='uint8')
+
+        def measure_motion():
+            nonlocal last_frames
 
             # We're going to collect new frames by rolling through all awaiting updates, saving only the last actual
             # frame for each source. In effect, to avoid computational slowdown, we're diff-ing only with the most
@@ -35,30 +52,48 @@ class VideoMovementFeature(PipelineProcess):
             for update_step in get_all_from_queue(input_queue):
                 for source_id, frame_list in update_step.items():
                     if frame_list:
-                        frame = frame_list[-1]
+                        frame = decode_frame(frame_list[-1], (width, height))  # reduced scale if compressed
+                        pool.release(new_frames.get(source_id))
                         new_frames[source_id] = frame if frame.shape == (height, width, 3) \
-                            else cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+                            else resize_into(frame, (width, height), pool)
 
             for source in last_frames.keys() - new_frames.keys():
-                new_frames[source] = last_frames[source]
+                new_frames[source] = pool.retain(last_frames[source])
 
             # Calculated diffs between new and last frames
-            diffs = {source: cv2.absdiff(new_frames[source], last_frames[source]) for source in new_frames
-                     if (new_frames[source] is not None and last_frames[source] is not None)}
-            diffs = {source: cv2.threshold(diff, 25, 255, cv2.THRESH_BINARY)[1] for source, diff in diffs.items()}
-            diffs = {source: frame.sum() / frame.size for source, frame in diffs.items()}
+            diffs = {}
+            for source in new_frames:
+                if new_frames[source] is not None and last_frames[source] is not None:
+                    cv2.absdiff(new_frames[source], last_frames[source], dst=diff_buffer)
+                    cv2.threshold(diff_buffer, 25, 255, cv2.THRESH_BINARY, dst=diff_buffer)
+                    diffs[source] = diff_buffer.sum() / diff_buffer.size
 
-            # Identify source with max diff; append to window; update last_frames
-            max_source = max(diffs, key=lambda source: diffs[source], default=next(iter(new_frames)))
-            window.append(max_source)
-
-            # Update last_frames with new data
+            # Update last_frames with new data, returning replaced frames to the pool
+            for frame in last_frames.values():
+                pool.release(frame)
             last_frames = {source: new_frames[source] if new_frames[source] is not None
             else last_frames[source] for source in new_frames}
 
+            return diffs
+
+        def weight_sources():
+            nonlocal window
+
+            # Measure motion in each source, or replay the cached measurement for this point in the run.
+            if track is not None and track.replaying:
+                diffs = dict(zip(source_ids, track.lookup()))
+            else:
+                diffs = measure_motion()
+                if track is not None:
+                    track.record([diffs.get(source, 0.0) for source in source_ids])
+
+            # Identify source with max diff; append to window
+            max_source = max(diffs, key=lambda source: diffs[source], default=source_ids[0])
+            window.append(max_source)
+
             # Vote proportionally based on count in window
             vote = Distribution(Counter(window))
-            for key in new_frames.keys() - vote.keys():  # add missing keys
+            for key in set(source_ids) - vote.keys():  # add missing keys
                 vote[key] = 0.0
             vote.normalize()  # scale down to [0, 1]
 
@@ -67,3 +102,6 @@ class VideoMovementFeature(PipelineProcess):
 
         scheduler = create_periodic_event(interval=1 / 30, action=weight_sources)
         scheduler.run()
+
+        if track is not None:
+            track.finish()
@@ -0,0 +1,101 @@
+import numpy
+
+from util.automixer import GainSharingMixer
+from util.pipeline import PipelineProcess, get_all_from_queue
+from util.resample import StreamingResampler
+from util.schedule import create_periodic_event
+
+
+class AudioResampler(PipelineProcess):
+    """
+    Sits between an audio source and its consumers, converting the source's audio to another sample rate. This lets
+    each device run at its native rate, and lets analysis run at a cheaper rate than playback.
+    """
+
+    def __init__(self, input_stream, sample_rate, interval=1 / 30):
+        self.source_id = input_stream.source_id
+        self.sample_rate = sample_rate
+        super().__init__(pipeline_id='RS-' + str(sample_rate) + '-' + input_stream.id,
+                         target_function=AudioResampler.resample_audio,
+                         params=(input_stream.sample_rate, sample_rate, interval),
+                         sources=[input_stream])
+
+    @staticmethod
+    def resample_audio(input_queue, output_queue, input_rate, output_rate, interval):
+        resampler = StreamingResampler(input_rate, output_rate)
+
+        def resample_frames():
+            for update_step in get_all_from_queue(input_queue):
+                for audio_frame_list in update_step.values():
+                    for frame in audio_frame_list:
+                        if frame is not None:
+                            output_queue.put_nowait(resampler.process(frame))
+
+        scheduler = create_periodic_event(interval=interval, action=resample_frames)
+        scheduler.run()
+
+        # Stopped: pass on what is left in the queue.
+        resample_frames()
+
+
+class AudioAutomixer(PipelineProcess):
+    """
+    Mixes several microphones into the program audio with gain sharing (see util/automixer.py), so whoever is talking
+    is heard through their own mic. Inputs must share the mixer's sample rate (see resampled). Blocks from different
+    mics arrive unevenly, so each mic's samples are queued and mixed as soon as every mic has supplied them; a mic
+    that falls more than max_latency behind the others is padded with silence rather than holding up the mix.
+    """
+
+    def __init__(self, mixer_id, input_streams, sample_rate, max_latency=0.2, interval=1 / 30):
+        self.source_id = mixer_id
+        self.sample_rate = sample_rate
+        super().__init__(pipeline_id='AM-' + str(mixer_id),
+                         target_function=AudioAutomixer.mix_audio,
+                         params=([stream.id for stream in input_streams], sample_rate, max_latency, interval),
+                         sources=input_streams)
+
+    @staticmethod
+    def mix_audio(input_queue, output_queue, input_ids, sample_rate, max_latency, interval):
+        mixer = GainSharingMixer(len(input_ids), sample_rate)
+        pending = {input_id: [] for input_id in input_ids}  # queued sample blocks per mic
+        max_backlog = int(max_latency * sample_rate)
+        dtype = None
+
+        def mix_frames():
+            nonlocal dtype
+            for update_step in get_all_from_queue(input_queue):
+                for source_id, audio_frame_list in update_step.items():
+                    pending[source_id] += [frame.reshape(-1) for frame in audio_frame_list if frame is not None]
+            if dtype is None:
+                dtype = next((blocks[0].dtype for blocks in pending.values() if blocks), None)
+            if dtype is None:
+                return
+
+            queued = {input_id: numpy.concatenate(blocks) if blocks else numpy.zeros(0, dtype=dtype)
+                      for input_id, blocks in pending.items()}
+            length = min(len(samples) for samples in queued.values())
+            if max(len(samples) for samples in queued.values()) > max_backlog:
+                length = max(len(samples) for samples in queued.values())
+            if length == 0:
+                return
+
+            block = numpy.zeros((len(input_ids), length), dtype=dtype)
+            for index, input_id in enumerate(input_ids):
+                available = queued[input_id][:length]
+                block[index, :len(available)] = available
+                pending[input_id] = [queued[input_id][length:]]
+
+            mixed = mixer.process(block)
+            if len(mixed):
+                output_queue.put_nowait(mixed)
+
+        scheduler = create_periodic_event(interval=interval, action=mix_frames)
+        scheduler.run()
+
+        # Stopped: mix what is left in the queue.
+        mix_frames()
+
+
+def resampled(stream, sample_rate):
+    """ Returns a resampler for the stream, or the stream itself if it is already at the given sample rate. """
+    return stream if stream.sample_rate == sample_rate else AudioResampler(stream, sample_rate)
@@ -1,9 +1,12 @@
+import time
+
 import numpy
 import sounddevice
 import soundfile
 
+from util.compressed_frames import decode_frame, is_frame
 from util.pipeline import PipelineProcess, get_all_from_queue
-from util.schedule import create_periodic_event
+from util.schedule import create_periodic_event, shedding
 
 
 class ReadFromOutputException(Exception):
@@ -14,7 +17,38 @@ class ReadFromOutputException(Exception):
 ###########################################################################################################
 
 
+class Window:
+    """
+    A display window that measures the CPU time spent in imshow/waitKey, which is the CPU a display stage saves when
+    the system runs headless. The measurement covers the calling thread only, so stages fused into one process are
+    measured separately.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.cpu_seconds = 0.0
+        self.frames = 0
+        self._start_time = time.time()
+
+    def show(self, frame):
+        import cv2
+        start = time.thread_time()
+        cv2.imshow(self.name, frame)
+        cv2.waitKey(1)
+        self.cpu_seconds += time.thread_time() - start
+        self.frames += 1
+
+    def close(self):
+        import cv2
+        cv2.destroyWindow(self.name)
+        elapsed = time.time() - self._start_time
+        print("Window '{}': {:.2f} s CPU in imshow/waitKey over {} frames ({:.2f} ms per frame, {:.1%} of a core)."
+              .format(self.name, self.cpu_seconds, self.frames, 1000 * self.cpu_seconds / max(self.frames, 1),
+                      self.cpu_seconds / max(elapsed, 1e-9)))
+
+
 class OutputVideoStream(PipelineProcess):
+    shed_level = 3
 
     def __init__(self, stream_id, input_stream, dimensions=(640, 480), interval=1 / 30):
         super().__init__(pipeline_id='OVS-' + str(stream_id),
@@ -28,7 +62,9 @@ class OutputVideoStream(PipelineProcess):
     @staticmethod
     def show_video(input_queue, output_queue, stream_id, dimensions, interval):
         import cv2
+        window = Window(stream_id)
         last_frame = numpy.zeros((dimensions[1], dimensions[0], 3), dtype='uint8')
+        display_frame = numpy.zeros_like(last_frame)  # resized into in place each frame
 
         def display_video_frame():
             nonlocal last_frame
@@ -44,15 +80,69 @@ class OutputVideoStream(PipelineProcess):
 
             # Update and display the last frame.
             if frame_list:
-                last_frame = frame_list[-1]
-                cv2.imshow(stream_id, cv2.resize(last_frame, dimensions, interpolation=cv2.INTER_AREA))
-                cv2.waitKey(1)
+                last_frame = decode_frame(frame_list[-1])  # the program feed is decoded in full
+                if last_frame.shape != display_frame.shape:
+                    cv2.resize(last_frame, dimensions, dst=display_frame, interpolation=cv2.INTER_AREA)
+                    last_frame = display_frame
+                window.show(last_frame)
 
         scheduler = create_periodic_event(interval=interval, action=display_video_frame)
         scheduler.run()
+        window.close()
+
+
+class TileGrid:
+    """
+    Composites frames from several inputs into one grid frame. The grid frame is allocated once per resolution; open
+    spots in the grid are left black. Each input owns a tile (a view into the grid frame) and a resize buffer, so
+    compositing allocates nothing per frame.
+    """
+
+    def __init__(self, input_ids, dimensions):
+        import math
+        self.input_ids = input_ids
+        self.dimensions = dimensions
+        self.scale_factor = math.ceil(math.sqrt(len(input_ids)))
+        self.resolution_scale = None
+        self.build(1.0)
+
+    def build(self, resolution_scale):
+        """ Reallocates the grid at a fraction of full resolution. """
+        self.resolution_scale = resolution_scale
+        self.width = int(self.dimensions[0] * resolution_scale / self.scale_factor)
+        self.height = int(self.dimensions[1] * resolution_scale / self.scale_factor)
+        self.combined = numpy.zeros((self.height * self.scale_factor, self.width * self.scale_factor, 3),
+                                    dtype='uint8')
+        self.tiles = {input_id: self.combined[(index // self.scale_factor) * self.height:
+                                              (index // self.scale_factor + 1) * self.height,
+                                              (index % self.scale_factor) * self.width:
+                                              (index % self.scale_factor + 1) * self.width]
+                      for index, input_id in enumerate(self.input_ids)}
+        self.resize_buffers = {input_id: numpy.zeros((self.height, self.width, 3), dtype='uint8')
+                               for input_id in self.input_ids}
+
+    def update(self, input_queue):
+        """ Redraws the tiles of inputs with new frames waiting in the queue. Returns whether any tile changed. """
+        import cv2
+
+        new_frames = {}
+        for update_step in get_all_from_queue(input_queue):
+            for source_id, frame_list in update_step.items():
+                if frame_list and is_frame(frame_list[-1]):
+                    new_frames[source_id] = frame_list[-1]
+
+        for source_id, frame in new_frames.items():
+            frame = decode_frame(frame, (self.width, self.height))  # reduced scale if compressed
+            if frame.shape != (self.height, self.width, 3):
+                frame = cv2.resize(frame, (self.width, self.height), dst=self.resize_buffers[source_id],
+                                   interpolation=cv2.INTER_AREA)
+            self.tiles[source_id][...] = frame
+
+        return bool(new_frames)
 
 
 class OutputTiledVideoStream(PipelineProcess):
+    shed_level = 2
 
     def __init__(self, stream_id, inputs, dimensions=(640, 480), interval=1 / 30):
         super().__init__(pipeline_id='OVS-' + str(stream_id),
@@ -65,49 +155,90 @@ class OutputTiledVideoStream(PipelineProcess):
 
     @staticmethod
     def show_video(input_queue, output_queue, stream_id, input_ids, dimensions, interval):
-        import cv2, math, numpy
-
-        # Calculate dimensions for output grid frames
-        scale_factor = math.ceil(math.sqrt(len(input_ids)))
-        width, height = int(dimensions[0]/scale_factor), int(dimensions[1]/scale_factor)
-
-        # Create empty frames for open spots in grid
-        padding_frames = [numpy.zeros((height, width, 3), dtype='uint8')
-                          for _ in range(scale_factor**2 - len(input_ids))]
-
-        last_frames = {input_id: numpy.zeros((height, width, 3), dtype='uint8')
-                       for input_id in input_ids}
+        window = Window(stream_id)
+        grid = TileGrid(input_ids, dimensions)
 
         def display_video_frame():
-            nonlocal last_frames, scale_factor, height, width, padding_frames
-
-            # grab new frames from input
-            new_frames = {}
-            for update_step in get_all_from_queue(input_queue):
-                for source_id, frame_list in update_step.items():
-                    if frame_list and type(frame_list[-1]) == numpy.ndarray:
-                        new_frames[source_id] = frame_list[-1]
+            # Under load, the preview drops to half resolution (its rate is reduced by the scheduler).
+            if grid.resolution_scale != (0.5 if shedding() else 1.0):
+                grid.build(0.5 if shedding() else 1.0)
 
-            last_frames.update(new_frames)
-
-            # Pad in extra frames for complete square
-            frames = list(frame if frame.shape == (height, width, 3)
-                          else cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
-                          for frame in last_frames.values())
-            frames += padding_frames
-
-            # Merge frames into one large frame
-            rows = []
-            for row in range(scale_factor):
-                rows.append(numpy.hstack(tuple(frames[row*scale_factor + i] for i in range(scale_factor))))
-            combined = numpy.vstack(tuple(rows))
+            # Only tiles with new frames are redrawn
+            grid.update(input_queue)
 
             # Display
-            cv2.imshow(stream_id, combined)
-            cv2.waitKey(1)
+            window.show(grid.combined)
 
         scheduler = create_periodic_event(interval=interval, action=display_video_frame)
         scheduler.run()
+        window.close()
+
+
+class OutputHTTPStream(PipelineProcess):
+    """
+    Serves video as MJPEG over HTTP on a local port, for viewing without a display attached. A single input is served
+    as is (e.g. the program feed, rewired by the selector); several inputs are tiled like the preview. Each rendition
+    (a name and a resolution scale) is encoded once per new frame, and only while it has clients, then shared by all
+    of its clients. Slow clients skip frames rather than holding up the pipeline.
+    """
+    shed_level = 2
+
+    def __init__(self, stream_id, inputs, port, host='127.0.0.1', program=False, renditions=None, quality=80,
+                 dimensions=(640, 480), interval=1 / 30):
+        """ Serves on host, this machine only by default. A program feed sheds work last, like the program display;
+            otherwise the stream sheds with the preview.
+        """
+        renditions = renditions or {'full': 1.0}
+        if program:
+            self.shed_level = OutputVideoStream.shed_level
+        super().__init__(pipeline_id='OHS-' + str(stream_id),
+                         target_function=OutputHTTPStream.serve_video,
+                         params=(host, port, [input.id for input in inputs] if len(inputs) > 1 else None,
+                                 renditions, quality, dimensions, interval),
+                         sources=inputs)
+
+    def read(self):
+        raise ReadFromOutputException('Attempted read from an output pipeline function.' + str(self.__class__))
+
+    @staticmethod
+    def serve_video(input_queue, output_queue, host, port, tiled_input_ids, renditions, quality, dimensions,
+                    interval):
+        import cv2
+        from util.mjpeg_server import MJPEGServer
+
+        server = MJPEGServer(port, renditions, host=host)
+        grid = TileGrid(tiled_input_ids, dimensions) if tiled_input_ids else None
+        frame = numpy.zeros((dimensions[1], dimensions[0], 3), dtype='uint8')
+        rendition_buffers = {name: numpy.zeros((int(dimensions[1] * scale), int(dimensions[0] * scale), 3),
+                                               dtype='uint8') for name, scale in renditions.items()}
+
+        def serve_video_frame():
+            nonlocal frame
+
+            if grid is not None:
+                if not grid.update(input_queue):
+                    return
+                frame = grid.combined
+            else:
+                # Only the newest frame matters; the clients see a live feed.
+                frame_lists = [frame_list for update_step in get_all_from_queue(input_queue)
+                               for frame_list in update_step.values() if frame_list]
+                if not frame_lists:
+                    return
+                frame = decode_frame(frame_lists[-1][-1])
+
+            # Encode once per watched rendition; every client of the rendition shares the encoded frame.
+            for name, buffer in rendition_buffers.items():
+                if server.clients(name):
+                    scaled = frame if frame.shape == buffer.shape else \
+                        cv2.resize(frame, buffer.shape[1::-1], dst=buffer, interpolation=cv2.INTER_AREA)
+                    status, encoded = cv2.imencode('.jpg', scaled, [cv2.IMWRITE_JPEG_QUALITY, quality])
+                    if status:
+                        server.publish(name, encoded.tobytes())
+
+        scheduler = create_periodic_event(interval=interval, action=serve_video_frame)
+        scheduler.run()
+        server.close()
 
 
 class OutputAudioStream(PipelineProcess):
@@ -136,6 +267,9 @@ class OutputAudioStream(PipelineProcess):
 
         scheduler = create_periodic_event(interval=interval, action=write_audio_frames)
         scheduler.run()
+
+        # Stopped: play out what is left in the queue, then release the device.
+        write_audio_frames()
         stream.close()
 
 ###########################################################################################################
@@ -162,22 +296,27 @@ class OutputVideoFile(PipelineProcess):
         stream = cv2.VideoWriter(filename, cv2.VideoWriter_fourcc(*'XVID'), video_fps, dimensions)
 
         last_frame = numpy.zeros((dimensions[1], dimensions[0], 3), dtype='uint8')
+        resize_buffer = numpy.zeros_like(last_frame)  # resized into in place; doubles as the padding frame
         frames_processed = 0
-        start_time = time.clock()
+        start_time = time.perf_counter()
+
+        def resize(frame):
+            frame = decode_frame(frame)  # the program feed is decoded in full
+            return frame if frame.shape[0:2][::-1] == dimensions else cv2.resize(frame, dimensions, dst=resize_buffer,
+                                                                                 interpolation=cv2.INTER_AREA)
 
         def write_video_frames():
             nonlocal last_frame, start_time, frames_processed
 
             # drop and add frames as needed to keep up with live stream
-            frames_to_go = math.floor(video_fps * (time.clock() - start_time)) - frames_processed
+            frames_to_go = math.floor(video_fps * (time.perf_counter() - start_time)) - frames_processed
 
             # write frames from input
             for update_step in get_all_from_queue(input_queue):
                 assert len(update_step) == 1, 'Input too large.'
                 frame_list = next(iter(update_step.values()))
                 for frame in frame_list:
-                    last_frame = frame if frame.shape[0:2][::-1] == dimensions else cv2.resize(frame, dimensions,
-                                                                                               interpolation=cv2.INTER_AREA)
+                    last_frame = resize(frame)
                     stream.write(last_frame)
 
                     # keep track of progress
@@ -194,6 +333,13 @@ class OutputVideoFile(PipelineProcess):
         scheduler = create_periodic_event(interval=1.0/video_fps, action=write_video_frames)
         scheduler.run()
 
+        # Stopped: write every frame still queued, without dropping to keep pace, then finalize the file.
+        for update_step in get_all_from_queue(input_queue):
+            for frame_list in update_step.values():
+                for frame in frame_list:
+                    stream.write(resize(frame))
+        stream.release()
+
 
 class OutputAudioFile(PipelineProcess):
 
@@ -221,14 +367,19 @@ class OutputAudioFile(PipelineProcess):
         scheduler = create_periodic_event(interval=interval, action=write_audio_frames)
         scheduler.run()
 
+        # Stopped: write what is left in the queue, then flush and close the file.
+        write_audio_frames()
+        stream.close()
+
 ###########################################################################################################
 ########################################      Join Fn     #################################################
 ###########################################################################################################
 
 
-def join_audio_and_video(audio_filename, video_filename):
+def join_audio_and_video(audio_filename, video_filename, output_filename='output_files/output.avi'):
     import subprocess
 
-    cmd = 'ffmpeg -y -i ' + video_filename + ' -i ' + audio_filename + ' -shortest -async 1 -vsync 1 -codec copy output_files/output.avi'
+    cmd = 'ffmpeg -y -i ' + video_filename + ' -i ' + audio_filename + ' -shortest -async 1 -vsync 1 -codec copy ' + \
+        output_filename
     # flags  -codec copy
     subprocess.call(cmd, shell=True)
\ No newline at end of file
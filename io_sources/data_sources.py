@@ -2,6 +2,8 @@ import wave
 import numpy
 import sounddevice
 
+from util.buffer_pool import BufferPool, CaptureBuffer, resize_into
+from util.compressed_frames import CompressedFrame, compressed_read, open_compressed_capture, reduced_scale
 from util.pipeline import PipelineProcess
 from util.schedule import create_periodic_event
 
@@ -14,6 +16,7 @@ class InputAudioStream(PipelineProcess):
 
     def __init__(self, device_id, sample_rate, dtype, input_interval=1 / 30):
         self.source_id = device_id
+        self.sample_rate = sample_rate
         super().__init__(pipeline_id='AS-' + str(device_id),
                          target_function=InputAudioStream.stream_audio,
                          params=(device_id, sample_rate, dtype, input_interval),
@@ -42,35 +45,46 @@ class InputAudioStream(PipelineProcess):
 
 class InputVideoStream(PipelineProcess):
 
-    def __init__(self, device_id, target_dimensions=(640, 480), input_interval=1/30):
+    def __init__(self, device_id, target_dimensions=(640, 480), input_interval=1/30, compressed=False):
         self.source_id = device_id
         super().__init__(pipeline_id='VS-' + str(device_id),
                          target_function=InputVideoStream.stream_video,
-                         params=(device_id, target_dimensions, input_interval),
+                         params=(device_id, target_dimensions, input_interval, compressed),
                          sources=[])
 
     @staticmethod
-    def stream_video(input_queue, output_queue, device_id, target_dimensions, interval):
+    def stream_video(input_queue, output_queue, device_id, target_dimensions, interval, compressed):
         """
             This function is given to a sub-process for execution. It functions by opening an InputStream, then using
             a scheduler to periodically grab frames, placing them in the synced Queue from the VideoStream instance.
+            In compressed mode, MJPEG frames are passed on undecoded (see util/compressed_frames.py).
         """
         import cv2
         stream = cv2.VideoCapture(device_id)
+        if compressed and not open_compressed_capture(stream, is_file=False):
+            print('Camera {} does not deliver MJPEG; capturing decoded frames.'.format(device_id))
+            compressed = False
+
+        # Capture and resize write into recycled buffers rather than allocating new arrays every frame.
+        pool, capture_buffer = BufferPool(), CaptureBuffer()
 
         def grab_video_frame():
             nonlocal stream
 
             if stream.isOpened():
-                status, frame = stream.read()
-                if status:
+                status, frame = compressed_read(stream) if compressed else capture_buffer.read(stream)
+                if isinstance(frame, CompressedFrame):
+                    output_queue.put(frame)
+                elif status:
                     height, width, channels = frame.shape
                     if (width, height) != target_dimensions:
-                        frame = cv2.resize(frame, target_dimensions, interpolation=cv2.INTER_AREA)
-                    output_queue.put(frame)
+                        frame = resize_into(frame, target_dimensions, pool)
+                    output_queue.put(frame)  # the frame is serialized on put, so its buffer is free again
+                    pool.release(frame)
 
         scheduler = create_periodic_event(interval=interval, action=grab_video_frame)
         scheduler.run()
+        stream.release()
 
 
 ###########################################################################################################
@@ -82,6 +96,8 @@ class InputAudioFile(PipelineProcess):
 
     def __init__(self, filename, input_interval=1 / 30):
         self.source_id = filename
+        with wave.open(filename, 'rb') as stream:
+            self.sample_rate = stream.getframerate()
         super().__init__(pipeline_id='AF-' + filename,
                          target_function=InputAudioFile.read_from_file,
                          params=(filename, input_interval),
@@ -95,50 +111,74 @@ class InputAudioFile(PipelineProcess):
         frames_per_second = stream.getframerate()
         chunk_size = int(interval*frames_per_second)
         chunks_processed = 0
-        start_time = time.clock()
+        start_time = time.perf_counter()
 
         def read_frames():
             nonlocal frames_per_second, chunk_size, start_time, stream, chunks_processed
 
-            chunks_to_go = math.floor((time.clock() - start_time)/interval) - chunks_processed
+            chunks_to_go = math.floor((time.perf_counter() - start_time)/interval) - chunks_processed
             for _ in range(chunks_to_go):
                 # for compatibility with sound device output, need numpy array
                 # source: http://stackoverflow.com/questions/30550212/
                 # raw-numpy-array-from-real-time-network-audio-stream-in-python
                 raw_data = stream.readframes(nframes=chunk_size)
-                numpy_array = numpy.fromstring(raw_data, '<h')
+                numpy_array = numpy.frombuffer(raw_data, '<h')
 
                 output_queue.put_nowait(numpy_array)
                 chunks_processed += 1
 
         scheduler = create_periodic_event(interval=interval, action=read_frames)
         scheduler.run()
+        stream.close()
 
 
 class InputVideoFile(PipelineProcess):
 
-    def __init__(self, filename, input_interval=1 / 30):
+    def __init__(self, filename, input_interval=1 / 30, compressed=False):
         self.source_id = filename
+        self.compressed = compressed
         super().__init__(pipeline_id='VF-' + filename,
                          target_function=InputVideoFile.read_file,
-                         params=(filename, input_interval),
+                         params=(filename, input_interval, compressed),
                          sources=[])
 
+    def decode_scale(self, dimensions):
+        """ The scale divisor at which consumers decoding to the given dimensions see this file's frames: reduced
+            if the frames are passed on compressed (see util/compressed_frames.py), and 1 if they are decoded in full.
+        """
+        import cv2
+        if not self.compressed:
+            return 1
+
+        stream = cv2.VideoCapture(self.source_id)
+        try:
+            if not open_compressed_capture(stream, is_file=True):
+                return 1
+            return reduced_scale(int(stream.get(cv2.CAP_PROP_FRAME_WIDTH)), int(stream.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+                                 dimensions)
+        finally:
+            stream.release()
+
     @staticmethod
-    def read_file(input_queue, output_queue, filename, interval):
+    def read_file(input_queue, output_queue, filename, interval, compressed):
         import cv2, time, math
         stream = cv2.VideoCapture(filename)
+        if compressed and not open_compressed_capture(stream, is_file=True):
+            print('{} is not MJPEG; reading decoded frames.'.format(filename))
+            compressed = False
 
         frame_rate = stream.get(cv2.CAP_PROP_FPS)
         frames_processed = 0
-        start_time = time.clock()
+        start_time = time.perf_counter()
+
+        capture_buffer = CaptureBuffer()
 
         def read_frame():
             nonlocal stream, frame_rate, frames_processed, start_time
 
-            frames_to_go = math.floor(frame_rate * (time.clock() - start_time)) - frames_processed
+            frames_to_go = math.floor(frame_rate * (time.perf_counter() - start_time)) - frames_processed
             for _ in range(frames_to_go):
-                status, frame = stream.read()
+                status, frame = compressed_read(stream) if compressed else capture_buffer.read(stream)
                 if status:
                     output_queue.put_nowait(frame)
                     frames_processed += 1
@@ -147,5 +187,6 @@ class InputVideoFile(PipelineProcess):
 
         scheduler = create_periodic_event(interval=interval, action=read_frame)
         scheduler.run()
+        stream.release()
 
 
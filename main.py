@@ -1,7 +1,9 @@
 import ast
 import configparser
 import logging
+import signal
 import sys
+import time
 import traceback
 import cv2
 
@@ -12,25 +14,32 @@ from numpy import zeros
 from features.audio_feature import AudioFeature
 from features.video_movement_feature import VideoMovementFeature
 from io_sources.data_output import OutputVideoStream, OutputAudioStream, OutputAudioFile, OutputVideoFile, \
-    join_audio_and_video, OutputTiledVideoStream
+    join_audio_and_video, OutputTiledVideoStream, OutputHTTPStream
+from io_sources.audio_processing import AudioAutomixer, resampled
 from io_sources.data_sources import InputVideoStream, InputAudioStream, InputVideoFile, InputAudioFile
+from util.check_inputs import load_inventory, missing_devices
+from util.config_watcher import ConfigWatcher
 from util.distribution import Distribution
-from util.schedule import create_periodic_event
+from util.feature_cache import FeatureCache
+from util.governor import LoadGovernor
+from util.graph import SOURCE_TYPES, FEATURE_TYPES, MIXER_TYPES, OUTPUT_TYPES, config_graph, describe_plan, media, \
+    nodes_of_types, plan_fusion, producers, selector_node, validate_graph
+from util.pipeline import FusedPipeline
+from util.profiler import SamplingProfiler, merge_profiles
+from util.schedule import create_periodic_event, set_tick_observer
 from util.stream_selector import StreamSelector
+from util.vote_recorder import VoteRecorder
 
 InputMediaStreams = namedtuple("InputMediaStreams", ["audio", "video", "main_audio"])
 OutputMediaStreams = namedtuple("OutputMediaStreams", ["audio", "video", "main_video"])
 
-global_sample_rate = 16000  # 44100 16000
-global_dtype = 'Int16'  # float32  Int16
 
-
-def parse_config_settings():
+def parse_config_settings(filename='config.ini'):
     """
     Reads in config.ini file with parameters for the system. Uses ast module to parse config vars as literal Python.
     """
     config = configparser.ConfigParser()
-    config.read('config.ini')
+    config.read(filename)
     config = config._sections
 
     for section_name, section in config.items():
@@ -40,102 +49,335 @@ def parse_config_settings():
     return config
 
 
+def check_device_inventory(live_parameters):
+    """
+    Compares the configured devices against the inventory written by util/check_inputs.py, rather than probing
+    every device at startup. Problems are logged, as the inventory may be stale.
+    """
+    inventory = load_inventory()
+    if inventory is None:
+        logging.warning('No device inventory found. Run util/check_inputs.py to create one.')
+        return
+
+    cameras, microphones = missing_devices(inventory,
+                                           camera_ids=live_parameters['active_camera_ids'],
+                                           microphone_ids=live_parameters['active_microphone_ids'])
+    if cameras or microphones:
+        logging.warning('Devices missing from inventory. Cameras: %s Microphones: %s', cameras, microphones)
+        print('Warning: configured devices not found in inventory. Cameras:', cameras, 'Microphones:', microphones)
+
+
+def fusion_settings(parameters):
+    """ The fusion overrides from the GRAPH section of the config. """
+    graph_parameters = parameters.get('GRAPH', {})
+    return {'fuse': graph_parameters.get('fuse', []),
+            'no_fuse': graph_parameters.get('no_fuse', []),
+            'auto_fuse': graph_parameters.get('auto_fuse', True)}
+
+
+def build_system(parameters, existing=None):
+    """
+    Builds the inputs, features and outputs described by the pipeline graph (see util/graph.py), fusing co-located
+    stages into shared processes as planned. Pipelines are registered under keys that capture everything they were
+    constructed with, so pipelines in the existing registry are reused wherever their configuration is unchanged.
+    Returns the components along with the new registry.
+    """
+    existing = existing or {}
+    registry = {}
+
+    def build(key, factory):
+        registry[key] = existing[key] if key in existing else factory()
+        return registry[key]
+
+    graph = config_graph(parameters)
+    validate_graph(graph)
+    groups = plan_fusion(graph, **fusion_settings(parameters))
+    group_of = {node: tuple(group) for group in groups for node in group}
+    selector = selector_node(graph)
+
+    def node_key(node, inputs=()):
+        """ A node's spec, process group and the identities of the pipelines it reads from. """
+        return (node, repr(sorted(graph['nodes'][node].items())), group_of.get(node)) + \
+            tuple(id(input) for input in inputs)
+
+    audio = parameters['AUDIO']
+    pipelines = {}
+
+    def resample(node, sample_rate):
+        stream = pipelines[node]
+        return build(('RS', id(stream), sample_rate), partial(resampled, stream, sample_rate))
+
+    # Streams of input data. Each audio device runs at its native sample rate.
+    for node in nodes_of_types(graph, SOURCE_TYPES):
+        spec = graph['nodes'][node]
+        if spec['type'] == 'camera':
+            pipelines[node] = build(node_key(node), partial(InputVideoStream, spec['device_id'],
+                                                            compressed=spec.get('compressed', False)))
+        elif spec['type'] == 'microphone':
+            sample_rate = spec.get('sample_rate', audio['input_sample_rates'].get(spec['device_id'],
+                                                                                   audio['default_sample_rate']))
+            pipelines[node] = build(node_key(node) + (sample_rate, audio['dtype']),
+                                    partial(InputAudioStream, spec['device_id'], sample_rate=sample_rate,
+                                            dtype=audio['dtype']))
+        elif spec['type'] == 'video_file':
+            pipelines[node] = build(node_key(node), partial(InputVideoFile, spec['filename'],
+                                                            compressed=spec.get('compressed', False)))
+        else:
+            pipelines[node] = build(node_key(node), partial(InputAudioFile, spec['filename']))
+
+    candidate_video = [pipelines[node] for node in producers(graph, selector) if node in pipelines]
+
+    # Features for selecting a stream. In file mode, their measurements can be cached across runs.
+    cache = FeatureCache(parameters['CACHE']['directory'], parameters['CACHE']['max_bytes']) \
+        if parameters['CACHE']['enabled'] and not parameters['MODE']['live_mode'] else None
+
+    analysis_audio = []
+    # Features without weight are not built at all, so they do not run (and are rebuilt fresh if weighted again).
+    feature_weights = parameters['SELECTOR']['feature_weights']
+    for node in nodes_of_types(graph, FEATURE_TYPES):
+        if feature_weights.get(node, 0) <= 0:
+            continue
+        spec, inputs = graph['nodes'][node], producers(graph, node)
+        if spec['type'] == 'movement_feature':
+            sources = [pipelines[input] for input in inputs]
+            pipelines[node] = build(node_key(node, sources),
+                                    partial(VideoMovementFeature, feature_id=node, video_sources=sources,
+                                            cache=cache))
+        else:
+            # Audio analysis runs at a cheap sample rate.
+            sources = {input: resample(input, audio['analysis_sample_rate']) for input in inputs}
+            audio_video_pairs = {sources[audio_node].id: pipelines[video_node].id
+                                 for audio_node, video_node in spec['pairs'].items()}
+            pipelines[node] = build(node_key(node, sources.values()),
+                                    partial(AudioFeature, feature_id=node, audio_sources=list(sources.values()),
+                                            audio_video_pair_map=audio_video_pairs, cache=cache))
+            if not pipelines[node].replaying:  # replayed measurements need no audio read or resampled
+                analysis_audio += sources.values()
+
+    # Mixers combine mics into program audio, at the output sample rate.
+    for node in nodes_of_types(graph, MIXER_TYPES):
+        sources = [resample(input, audio['output_sample_rate']) for input in producers(graph, node)]
+        pipelines[node] = build(node_key(node, sources) + (audio['output_sample_rate'],),
+                                partial(AudioAutomixer, node, sources, sample_rate=audio['output_sample_rate']))
+
+    # Program audio runs at the output sample rate.
+    program_audio = [resample(node, audio['output_sample_rate'])
+                     for node in {producers(graph, output)[0]
+                                  for output in nodes_of_types(graph, ['audio_output', 'audio_file_output'])}]
+
+    # Output streams and files. Program outputs (fed by the selector) and audio outputs are rewired rather than
+    # rebuilt when their input changes.
+    main_video_outputs, output_video_streams, output_audio_streams = [], [], []
+    for node in nodes_of_types(graph, OUTPUT_TYPES):
+        spec = graph['nodes'][node]
+        inputs = [pipelines.get(input, candidate_video[0]) for input in producers(graph, node)]
+        is_program = selector in producers(graph, node)
+
+        if spec['type'] == 'display':
+            output = build(node_key(node, [] if is_program else inputs),
+                           partial(OutputVideoStream, stream_id=spec.get('title', node), input_stream=inputs[0]))
+        elif spec['type'] == 'tiled_display':
+            output = build(node_key(node, inputs),
+                           partial(OutputTiledVideoStream, stream_id=spec.get('title', node), inputs=inputs))
+        elif spec['type'] == 'http_stream':
+            output = build(node_key(node, [] if is_program else inputs),
+                           partial(OutputHTTPStream, stream_id=spec.get('title', node), inputs=inputs,
+                                   port=spec['port'], host=spec.get('host', '127.0.0.1'), program=is_program,
+                                   renditions=spec.get('renditions'), quality=spec.get('quality', 80)))
+        elif spec['type'] == 'video_file_output':
+            output = build(node_key(node, [] if is_program else inputs),
+                           partial(OutputVideoFile, filename=spec['filename'], input_stream=inputs[0]))
+        elif spec['type'] == 'audio_output':
+            output = build(node_key(node) + (audio['output_sample_rate'], audio['dtype']),
+                           partial(OutputAudioStream, device_id=spec['device_id'], input_stream=program_audio[0],
+                                   sample_rate=audio['output_sample_rate'], dtype=audio['dtype']))
+        else:
+            output = build(node_key(node) + (audio['output_sample_rate'],),
+                           partial(OutputAudioFile, filename=spec['filename'], input_stream=program_audio[0],
+                                   sample_rate=audio['output_sample_rate']))
+
+        if media(graph, node) == 'audio':
+            output.set_inputs(program_audio)
+            output_audio_streams.append(output)
+        elif is_program:
+            main_video_outputs.append(output)
+        else:
+            output.set_inputs(inputs)
+            output_video_streams.append(output)
+        pipelines[node] = output
+
+    # Fuse planned groups into shared processes. Members whose output is read outside the group (by other pipelines
+    # or by the selector) still pass it to the main process. Readers change as the config does, so a fused process is
+    # rebuilt whenever its members' outside readers change.
+    built = set(registry.values())
+    for group in groups:
+        group = [node for node in group if node in pipelines]  # unweighted features are not built
+        if len(group) > 1:
+            members = [pipelines[node] for node in group]
+            external = [pipelines[node].id for node in group
+                        if graph['nodes'][node]['type'] in FEATURE_TYPES or pipelines[node] in candidate_video or
+                        any(pipelines[node] in pipeline.inputs() for pipeline in built - set(members))]
+            build(('FP',) + tuple(id(member) for member in members) + tuple(external),
+                  partial(FusedPipeline, members, external))
+
+    inputs = InputMediaStreams(audio=analysis_audio, video=candidate_video, main_audio=program_audio)
+    outputs = OutputMediaStreams(audio=output_audio_streams, video=output_video_streams,
+                                 main_video=main_video_outputs)
+
+    weighted_feature_distribution = Distribution({pipelines[node]: feature_weights[node]
+                                                  for node in nodes_of_types(graph, FEATURE_TYPES)
+                                                  if node in pipelines})
+
+    return inputs, weighted_feature_distribution, outputs, registry
+
+
+def dry_run(parameters):
+    """ Prints the process layout the config would produce, without starting anything. """
+    graph = config_graph(parameters)
+    validate_graph(graph)
+    print(describe_plan(graph, plan_fusion(graph, **fusion_settings(parameters))))
+
+
 def init():
     """
     Initializes system using parameters read from config file.
     """
     parameters = parse_config_settings()
 
-    # Streams of input data
     if parameters['MODE']['live_mode']:
-        input_audio = [InputAudioStream(id, sample_rate=global_sample_rate, dtype=global_dtype)
-                       for id in parameters['LIVE']['active_microphone_ids']]
-        main_audio_input = [stream for stream in input_audio
-                            if stream.source_id == parameters['LIVE']['audio_input_device_id']][0]
-        input_video = [InputVideoStream(id) for id in parameters['LIVE']['active_camera_ids']]
+        check_device_inventory(parameters['LIVE'])
 
-        audio_video_pairs = {audio.id: video.id for audio, video in zip(input_audio, input_video)}
+    inputs, weighted_feature_distribution, outputs, registry = build_system(parameters)
 
-    else:
-        input_audio = [InputAudioFile(filename) for filename in parameters['FILES']['audio_filenames']]
-        main_audio_input = InputAudioFile(filename=parameters['FILES']['main_audio_file'])
-        input_video = [InputVideoFile(filename) for filename in parameters['FILES']['video_filenames']]
+    # Optionally record votes and decisions for offline tuning (see util/tuning.py)
+    recorder = VoteRecorder(parameters['SELECTOR']['vote_recording']) \
+        if parameters['SELECTOR'].get('vote_recording') else None
 
-        audio_video_pairs = {audio: video for audio, video in zip([file_stream.id for file_stream in input_audio],
-                                                                  [file_stream.id for file_stream in input_video])}
+    # Degrade analysis and preview work under load, keeping program audio and the recording intact
+    governor = LoadGovernor(high_load=parameters['GOVERNOR']['high_load'], low_load=parameters['GOVERNOR']['low_load']) \
+        if parameters['GOVERNOR']['enabled'] else None
 
-    inputs = InputMediaStreams(audio=input_audio, video=input_video, main_audio=[main_audio_input])
+    # Return StreamSelector and params
+    selector = StreamSelector(inputs, weighted_feature_distribution, outputs,
+                              thrash_limit=parameters['SELECTOR']['thrash_limit'], recorder=recorder,
+                              governor=governor)
+    return selector, parameters, registry
 
-    # Output streams
-    output_audio_streams = [OutputAudioStream(device_id=parameters['OUTPUT_AUDIO']['audio_output_device_id'],
-                                              input_stream=main_audio_input, sample_rate=global_sample_rate,
-                                              dtype=global_dtype)]
 
-    # output_video_streams = [OutputVideoStream(stream_id=input_stream.id, input_stream=input_stream)
-    #                        for input_stream in input_video]
-    output_video_streams = [OutputTiledVideoStream(stream_id='Input Streams', inputs=input_video)]
+def reconfigure(selector, registry, parameters):
+    """
+    Applies new parameters to a running StreamSelector. Only pipelines whose own configuration changed are
+    restarted; everything else keeps running. Returns the new pipeline registry.
+    """
+    inputs, weighted_feature_distribution, outputs, registry = build_system(parameters, existing=registry)
+    selector.reconfigure(inputs, weighted_feature_distribution, outputs,
+                         thrash_limit=parameters['SELECTOR']['thrash_limit'])
 
-    main_video_outputs = [OutputVideoStream(stream_id="Main Output", input_stream=input_video[0])]
+    # Pipelines the selector does not run (or has just closed) must not be reused by later reconfigurations.
+    return {key: pipeline for key, pipeline in registry.items() if pipeline in selector.processes()}
 
-    # Output files
-    if parameters['OUTPUT_AUDIO']['audio_file']:
-        output_audio_streams.append(OutputAudioFile(filename=parameters['OUTPUT_AUDIO']['audio_filename'],
-                                                    input_stream=main_audio_input,
-                                                    sample_rate=global_sample_rate))
 
-    if parameters['OUTPUT_VIDEO']['video_file']:
-        output_video_file = OutputVideoFile(filename=parameters['OUTPUT_VIDEO']['video_filename'],
-                                            input_stream=input_video[0])
-        output_video_streams.append(output_video_file)
-        main_video_outputs.append(output_video_file)
+def update(selector, watcher, state):
+    """ A single system tick: apply any configuration changes, then update the selector. """
+    parameters = watcher.poll()
+    if parameters is not None:
+        try:
+            state['registry'] = reconfigure(selector, state['registry'], parameters)
+            state['parameters'] = parameters
+            logging.info('Applied configuration change.')
+        except Exception:
+            logging.exception('Failed to apply configuration change; keeping current configuration.')
 
-    outputs = OutputMediaStreams(audio=output_audio_streams, video=output_video_streams,
-                                 main_video=main_video_outputs)
+    # Profile everything for N seconds on request (SIGUSR1), then merge the per-process profiles into one report.
+    if state.pop('profile_requested', False):
+        seconds = state['parameters']['PROFILE']['seconds']
+        state['profile_report'] = (time.time(), time.time() + seconds + 1.0)
+        selector.profile(seconds)
+        SamplingProfiler('main').start(seconds)
 
-    # Features for selecting a stream
-    movement_feature = VideoMovementFeature(feature_id='F-Movement', video_sources=inputs.video)
+    if 'profile_report' in state and time.time() > state['profile_report'][1]:
+        started, _ = state.pop('profile_report')
+        report = merge_profiles(since=int(started))
+        logging.info('Merged profile written to %s', report)
+        print('Merged profile written to', report)
 
-    audio_feature = AudioFeature(feature_id='F-Audio', audio_sources=inputs.audio,
-                                 audio_video_pair_map=audio_video_pairs)
-    weighted_feature_distribution = Distribution({movement_feature: 0.7, audio_feature: 0.3})
+    selector.update()
 
-    # Return StreamSelector and params
-    return StreamSelector(inputs, weighted_feature_distribution, outputs), parameters
+
+def request_profile(state, *signal_args):
+    """ Signal handler requesting a profile of every process. """
+    state['profile_requested'] = True
+
+
+def request_halt(state, *signal_args):
+    """ Signal handler requesting an orderly shutdown (SIGTERM, or ctrl-c when headless). """
+    state['halt_requested'] = True
 
 
-def halt_check(selector, image=zeros((30, 30, 3))):
+def halt_check(state, headless, image=zeros((30, 30, 3))):
     """ This function provides the necessary check for terminating the system loop. """
+    if state.get('halt_requested'):
+        return True
+
+    # Headless systems are halted by signal only; no window is opened.
+    if headless:
+        return False
+
     # display blank image
     cv2.imshow('Exit', image)
 
     # Check for end key press (esc)
-    end = (cv2.waitKey(1) == 27)
-    if end:
-        selector.close()
-
-    return end
+    return cv2.waitKey(1) == 27
 
 if __name__ == '__main__':
+    if '--dry-run' in sys.argv:
+        dry_run(parse_config_settings())
+        sys.exit()
+
     logging.basicConfig(filename=__file__[:-3] + '.log', filemode='w', level=logging.DEBUG)
 
+    stream_selector = None
     try:
         # Initialize system sources and features calculated over sources
-        stream_selector, params = init()
+        stream_selector, params, pipeline_registry = init()
+        system_state = {'registry': pipeline_registry, 'parameters': params}
+
+        # SIGTERM (e.g. from a service manager) stops the system in order, as does ctrl-c when headless
+        headless = params['MODE'].get('headless', False)
+        signal.signal(signal.SIGTERM, partial(request_halt, system_state))
+        if headless:
+            signal.signal(signal.SIGINT, partial(request_halt, system_state))
+
+        # SIGUSR1 profiles every process for [PROFILE] seconds
+        if hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, partial(request_profile, system_state))
+
+        # Watch the config file, applying changes to the running system
+        config_watcher = ConfigWatcher('config.ini', parse=parse_config_settings)
+
+        # Measure the main loop alongside the pipelines
+        if stream_selector.governor is not None:
+            set_tick_observer(stream_selector.governor.main_monitor)
 
         # Initialize scheduler and set to repeat update calls indefinitely
         system = create_periodic_event(interval=1 / 30,
-                                       action=stream_selector.update,
-                                       action_args=(),
-                                       halt_check=partial(halt_check, stream_selector))
+                                       action=update,
+                                       action_args=(stream_selector, config_watcher, system_state),
+                                       halt_check=partial(halt_check, system_state, headless))
 
         # Execute
         system.run()
 
+        # Stop sources first and let every stage drain and finalize its files
+        stream_selector.close(deadline=system_state['parameters']['SHUTDOWN']['deadline'])
+
         # Kill windows
-        cv2.destroyAllWindows()
-        cv2.waitKey(1)
+        if not headless:
+            cv2.destroyAllWindows()
+            cv2.waitKey(1)
 
         # Create mixed audio/video file
+        params = system_state['parameters']
         if params['OUTPUT_AUDIO']['audio_file'] and params['OUTPUT_VIDEO']['video_file']:
             join_audio_and_video(params['OUTPUT_AUDIO']['audio_filename'], params['OUTPUT_VIDEO']['video_filename'])
 
@@ -143,6 +385,8 @@ if __name__ == '__main__':
 
     except KeyboardInterrupt:
         print('ctrl-c, leaving ...')
+        if stream_selector is not None:
+            stream_selector.close()
 
     except:
         traceback.print_exc(file=sys.stdout)
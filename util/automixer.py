@@ -0,0 +1,116 @@
+"""
+A gain-sharing (Dugan-style) automatic microphone mixer. Each channel's share of the program is its share of the
+total input level, so the active talker's mic is open, idle mics are attenuated, and the combined gain of all mics
+stays constant however many are in use (keeping the noise floor and feedback margin steady).
+
+Levels are measured over short hops, smoothed across hops, and the resulting gains are ramped sample by sample across
+each hop. Every step is vectorized over channels and samples; there are no per-sample Python loops.
+
+Usage (benchmark, reporting the fraction of one core used at 48 kHz):
+    python -m util.automixer
+"""
+import numpy
+
+
+class GainSharingMixer:
+    """ Mixes blocks of multichannel audio, shaped (channels, samples), into a single program channel. """
+
+    def __init__(self, channels, sample_rate, hop_seconds=0.001, time_constant=0.02, floor=1e-8):
+        """
+        hop_seconds is the resolution at which gains are computed, time_constant the smoothing applied to channel
+        levels, and floor a level (in mean-square full-scale units) below which channels are treated as silent, so
+        an all-silent room gets equal gains rather than noise-driven ones.
+        """
+        self.channels = channels
+        self.hop = max(1, int(round(hop_seconds * sample_rate)))
+        self.decay = numpy.exp(-self.hop / (time_constant * sample_rate))
+        self.floor = floor
+
+        self._levels = numpy.full(channels, floor, dtype='float64')  # smoothed mean-square level per channel
+        self._gains = numpy.full(channels, 1 / numpy.sqrt(channels), dtype='float32')  # gains at the last hop end
+        self._leftover = numpy.zeros((channels, 0), dtype='float32')  # samples short of a full hop
+        self._smoothing = {}  # per hop count: (hop count, hop count) smoothing matrix and decay of the initial level
+
+    def _smoothing_for(self, hops, max_cached=4):
+        """ One-pole smoothing of levels across hops, level[k] = decay * level[k-1] + (1 - decay) * power[k],
+            expressed as a matrix product so a block of hops is smoothed in one pass. Matrices are kept for the few
+            most recent hop counts, as blocks of a stream are mostly the same size.
+        """
+        if hops not in self._smoothing:
+            if len(self._smoothing) >= max_cached:
+                del self._smoothing[next(iter(self._smoothing))]  # the oldest
+            k = numpy.arange(hops)
+            exponents = k[:, None] - k[None, :]
+            matrix = numpy.where(exponents >= 0, (1 - self.decay) * self.decay ** numpy.maximum(exponents, 0), 0)
+            self._smoothing[hops] = matrix, self.decay ** (k + 1)
+        return self._smoothing[hops]
+
+    def process(self, block):
+        """
+        Mixes the next block, shaped (channels, samples), in any numeric dtype (integer samples are taken as full
+        scale at the dtype's limits). Returns the mixed samples now available, in the block's dtype; up to one hop of
+        samples is held back until the next block completes it.
+        """
+        block = numpy.asarray(block)
+        scale = float(numpy.iinfo(block.dtype).max) if numpy.issubdtype(block.dtype, numpy.integer) else 1.0
+
+        samples = numpy.concatenate((self._leftover, block.astype('float32') / scale), axis=1)
+        hops = samples.shape[1] // self.hop
+        self._leftover = samples[:, hops * self.hop:]
+        if hops == 0:
+            return numpy.zeros(0, dtype=block.dtype)
+        frames = samples[:, :hops * self.hop].reshape(self.channels, hops, self.hop)
+
+        # Smoothed level per channel and hop
+        power = numpy.einsum('chs,chs->ch', frames, frames) / self.hop
+        smoothing, initial_decay = self._smoothing_for(hops)
+        levels = power.dot(smoothing.T) + self._levels[:, None] * initial_decay[None, :]
+        self._levels = levels[:, -1]
+
+        # Each channel's share of the total level sets its power gain, so the gains' total power is always 1.
+        levels = numpy.maximum(levels, self.floor)
+        gains = numpy.sqrt(levels / levels.sum(axis=0, keepdims=True)).astype('float32')
+
+        # Ramp from the previous hop's gains to each hop's gains across its samples, then sum the channels.
+        targets = numpy.concatenate((self._gains[:, None], gains), axis=1)
+        ramp = numpy.arange(1, self.hop + 1, dtype='float32') / self.hop
+        sample_gains = targets[:, :-1, None] + numpy.diff(targets, axis=1)[:, :, None] * ramp
+        self._gains = gains[:, -1]
+
+        mixed = numpy.einsum('chs,chs->hs', sample_gains, frames).reshape(-1) * scale
+        if numpy.issubdtype(block.dtype, numpy.integer):
+            limits = numpy.iinfo(block.dtype)
+            return numpy.clip(numpy.rint(mixed), limits.min, limits.max).astype(block.dtype)
+        return mixed.astype(block.dtype)
+
+
+def benchmark(channel_counts=(4, 16, 32), sample_rate=48000, block_seconds=1 / 30, seconds=10.0):
+    """
+    Mixes synthetic speech-like bursts on many channels in real-time sized blocks and reports the CPU time per
+    second of audio, i.e. the fraction of one core the mixer needs.
+    """
+    import time
+
+    block_size = int(sample_rate * block_seconds)
+    blocks = int(seconds / block_seconds)
+    generator = numpy.random.RandomState(0)
+
+    for channels in channel_counts:
+        # One talker at a time over low-level noise on every channel
+        audio = (generator.randn(channels, block_size * 8) * 300).astype('int16')
+        for index in range(8):
+            audio[index % channels, index * block_size:(index + 1) * block_size] *= 30
+
+        mixer = GainSharingMixer(channels, sample_rate)
+        start = time.process_time()
+        for index in range(blocks):
+            offset = (index % 8) * block_size
+            mixer.process(audio[:, offset:offset + block_size])
+        cpu = time.process_time() - start
+
+        print('{:>3} channels at {} Hz: {:.2f} ms CPU per {:.1f} ms block, {:.1%} of one core'.format(
+            channels, sample_rate, 1000 * cpu / blocks, 1000 * block_seconds, cpu / seconds))
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,247 @@
+"""
+Offline batch processing of file-mode recordings. Rather than replaying the recordings in real time, the timeline is
+split into segments that are analyzed in parallel across a process pool. Each segment starts early by a warm-up
+overlap, so the features' sliding windows hold the same contents at the segment start as they would on a single
+timeline. The per-tick winners of all segments are stitched together and run through the selector's switching logic
+in one pass, giving one consistent edit list, from which the program video is rendered (again segment-parallel).
+
+Usage:
+    python -m util.batch [--config config.ini] [--segment-length SECONDS] [--processes N]
+"""
+import argparse
+import json
+import os
+import subprocess
+import wave
+from multiprocessing import Pool
+
+import cv2
+import numpy
+
+from util.tuning import apply_switching, tally_winners
+
+TICK = 1 / 30  # the feature and selector update interval
+WINDOW_LENGTH = 10  # the features' sliding window length, in ticks
+FEATURE_IDS = ['F-Movement', 'F-Audio']
+
+
+class TickReader:
+    """ Reads the frame showing at given times of a video file, decoding only the frames that are shown. """
+
+    def __init__(self, filename):
+        self.capture = cv2.VideoCapture(filename)
+        self.frame_rate = self.capture.get(cv2.CAP_PROP_FPS) or 1 / TICK
+        self.frame_count = int(self.capture.get(cv2.CAP_PROP_FRAME_COUNT))
+        self.position = 0  # index of the next frame in the file
+        self.frame = None
+
+    @property
+    def duration(self):
+        return self.frame_count / self.frame_rate
+
+    def frame_at(self, time):
+        """ The frame showing at the given time, or the last frame read once the file has ended. """
+        index = int(time * self.frame_rate)
+        if index < self.position - 1 or index > self.position + self.frame_rate:  # seek rather than skim
+            self.capture.set(cv2.CAP_PROP_POS_FRAMES, index)
+            self.position = index
+
+        while self.position <= index:
+            if not self.capture.grab():
+                break
+            self.position += 1
+            if self.position > index:
+                self.frame = self.capture.retrieve()[1]
+
+        return self.frame
+
+    def release(self):
+        self.capture.release()
+
+
+def plan_segments(total_ticks, segment_ticks, warmup_ticks):
+    """ Splits a timeline into (warm-up start, start, end) tick ranges. """
+    return [(max(0, start - warmup_ticks), start, min(start + segment_ticks, total_ticks))
+            for start in range(0, total_ticks, segment_ticks)]
+
+
+def measure_motion(video_filenames, first_tick, end_tick, dimensions=(640, 480)):
+    """ The thresholded frame difference of each video per tick, as measured by VideoMovementFeature. """
+    readers = [TickReader(filename) for filename in video_filenames]
+    motion = numpy.zeros((end_tick - first_tick, len(readers)), dtype='float32')
+    last_frames = [None] * len(readers)
+    frame, diff = numpy.zeros((dimensions[1], dimensions[0], 3), dtype='uint8'), None
+
+    for tick in range(first_tick, end_tick):
+        for index, reader in enumerate(readers):
+            source_frame = reader.frame_at(tick * TICK)
+            if source_frame is None:
+                continue
+            cv2.resize(source_frame, dimensions, dst=frame)
+            if last_frames[index] is not None:
+                diff = cv2.absdiff(frame, last_frames[index], dst=diff)
+                cv2.threshold(diff, 25, 255, cv2.THRESH_BINARY, dst=diff)
+                motion[tick - first_tick, index] = diff.sum() / diff.size
+                last_frames[index][:] = frame
+            else:
+                last_frames[index] = frame.copy()
+
+    for reader in readers:
+        reader.release()
+    return motion
+
+
+def measure_loudness(audio_filenames, first_tick, end_tick):
+    """ The peak sample of each audio file per tick, as measured by AudioFeature. """
+    loudness = numpy.zeros((end_tick - first_tick, len(audio_filenames)), dtype='float32')
+
+    for index, filename in enumerate(audio_filenames):
+        with wave.open(filename, 'rb') as stream:
+            frames_per_tick = int(TICK * stream.getframerate())
+            chunk_size = frames_per_tick * stream.getnchannels()  # samples per tick, interleaved across channels
+            stream.setpos(min(first_tick * frames_per_tick, stream.getnframes()))
+            samples = numpy.frombuffer(stream.readframes(frames_per_tick * (end_tick - first_tick)), '<h')
+
+        chunks = len(samples) // chunk_size
+        loudness[:chunks, index] = samples[:chunks * chunk_size].reshape(chunks, chunk_size).max(axis=1)
+
+    return loudness
+
+
+def window_votes(measurements, stream_indices, stream_count, window_length=WINDOW_LENGTH):
+    """
+    Vectorized version of the features' voting: each tick, the source with the highest measurement wins, and the
+    vote for each stream is its share of wins within the sliding window. stream_indices maps each measured source to
+    the video stream it votes for. Returns votes shaped (ticks, streams).
+    """
+    winners = numpy.asarray(stream_indices)[measurements.argmax(axis=1)]
+    wins = numpy.zeros((len(winners) + 1, stream_count), dtype='float32')
+    wins[numpy.arange(1, len(winners) + 1), winners] = 1
+
+    counts = numpy.cumsum(wins, axis=0)
+    counts = counts[1:] - counts[numpy.maximum(numpy.arange(1, len(winners) + 1) - window_length, 0)]
+    return counts / counts.sum(axis=1, keepdims=True)
+
+
+# Worker state; set once per pool process.
+_worker_settings = None
+
+
+def _init_worker(settings):
+    global _worker_settings
+    _worker_settings = settings
+
+
+def _segment_winners(segment):
+    """ The tallied winner per tick of a segment, measured from its warm-up start. """
+    warmup_start, start, end = segment
+    video_filenames, audio_filenames, weights = _worker_settings['video'], _worker_settings['audio'], \
+        _worker_settings['weights']
+    stream_count = len(video_filenames)
+
+    votes = numpy.stack([window_votes(measure_motion(video_filenames, warmup_start, end),
+                                      range(stream_count), stream_count),
+                         window_votes(measure_loudness(audio_filenames, warmup_start, end),
+                                      range(len(audio_filenames)), stream_count)], axis=1)
+    return tally_winners(votes, weights)[start - warmup_start:]
+
+
+def _render_segment(job):
+    """ Writes the program video for a tick range of the stitched selection. """
+    filename, video_filenames, selected, first_tick = job
+    writer = cv2.VideoWriter(filename, cv2.VideoWriter_fourcc(*'XVID'), 1 / TICK, (640, 480))
+    readers = {}
+    frame = numpy.zeros((480, 640, 3), dtype='uint8')
+
+    for tick, index in enumerate(selected.tolist(), start=first_tick):
+        if index not in readers:
+            readers[index] = TickReader(video_filenames[index])
+        source_frame = readers[index].frame_at(tick * TICK)
+        if source_frame is not None:
+            cv2.resize(source_frame, (640, 480), dst=frame)
+        writer.write(frame)
+
+    writer.release()
+    for reader in readers.values():
+        reader.release()
+
+
+def edit_list(selected, video_filenames):
+    """ Collapses the selected stream per tick into a list of (start seconds, end seconds, video filename) cuts. """
+    cuts = numpy.flatnonzero(numpy.diff(selected)) + 1
+    starts, ends = numpy.concatenate(([0], cuts)), numpy.concatenate((cuts, [len(selected)]))
+    return [(start * TICK, end * TICK, video_filenames[selected[start]])
+            for start, end in zip(starts.tolist(), ends.tolist())]
+
+
+def process_recordings(video_filenames, audio_filenames, weights, thrash_limit, segment_length=300.0,
+                       warmup=WINDOW_LENGTH * TICK, processes=None):
+    """
+    Selects the program stream for a set of aligned recordings, with audio_filenames[i] being the microphone paired
+    with video_filenames[i]. weights holds the movement and audio feature weights. Returns the selected stream index
+    per tick.
+    """
+    # The sliding windows fill within WINDOW_LENGTH ticks, plus one tick for the first frame difference.
+    warmup_ticks = max(int(round(warmup / TICK)), WINDOW_LENGTH + 1)
+    durations = []
+    for filename in video_filenames:
+        reader = TickReader(filename)
+        durations.append(reader.duration)
+        reader.release()
+
+    segments = plan_segments(int(min(durations) / TICK), int(segment_length / TICK), warmup_ticks)
+    settings = {'video': video_filenames, 'audio': audio_filenames, 'weights': weights}
+    with Pool(processes=processes, initializer=_init_worker, initargs=(settings,)) as pool:
+        winners = numpy.concatenate(pool.map(_segment_winners, segments, chunksize=1))
+
+    # Switching depends on the whole history, but is cheap: apply it once over the stitched timeline.
+    return apply_switching(winners, thrash_limit)
+
+
+def render(selected, video_filenames, output_filename, segment_length=300.0, processes=None):
+    """ Renders the program video for the selection, in parallel segments joined with ffmpeg. """
+    segment_ticks = int(segment_length / TICK)
+    starts = range(0, len(selected), segment_ticks)
+    parts = ['{}.part{}.avi'.format(os.path.splitext(output_filename)[0], index) for index in range(len(starts))]
+    jobs = [(part, video_filenames, selected[start:start + segment_ticks], start) for part, start in zip(parts, starts)]
+
+    with Pool(processes=processes) as pool:
+        pool.map(_render_segment, jobs, chunksize=1)
+
+    part_list = output_filename + '.parts.txt'
+    with open(part_list, 'w') as part_file:
+        part_file.writelines("file '{}'\n".format(os.path.abspath(part)) for part in parts)
+    subprocess.call(['ffmpeg', '-y', '-f', 'concat', '-safe', '0', '-i', part_list, '-c', 'copy', output_filename])
+
+    for filename in parts + [part_list]:
+        os.remove(filename)
+
+
+if __name__ == '__main__':
+    from io_sources.data_output import join_audio_and_video
+    from main import parse_config_settings
+
+    parser = argparse.ArgumentParser(description='Process file-mode recordings in parallel segments.')
+    parser.add_argument('--config', default='config.ini')
+    parser.add_argument('--segment-length', type=float, default=None, help='Seconds of recording per segment.')
+    parser.add_argument('--processes', type=int, default=None)
+    args = parser.parse_args()
+
+    parameters = parse_config_settings(args.config)
+    batch, files = parameters['BATCH'], parameters['FILES']
+    segment_length = args.segment_length or batch['segment_length']
+    processes = args.processes or batch['processes']
+
+    selected = process_recordings(files['video_filenames'], files['audio_filenames'],
+                                  [parameters['SELECTOR']['feature_weights'].get(feature_id, 0)
+                                   for feature_id in FEATURE_IDS],
+                                  parameters['SELECTOR']['thrash_limit'], segment_length, batch['warmup'], processes)
+
+    cuts = edit_list(selected, files['video_filenames'])
+    with open(batch['edit_list'], 'w') as edit_file:
+        json.dump(cuts, edit_file, indent=1)
+    print('{} cuts written to {}.'.format(len(cuts), batch['edit_list']))
+
+    render(selected, files['video_filenames'], batch['video_filename'], segment_length, processes)
+    name, extension = os.path.splitext(batch['video_filename'])
+    join_audio_and_video(files['main_audio_file'], batch['video_filename'], name + '_with_audio' + extension)
@@ -0,0 +1,143 @@
+from collections import defaultdict
+
+import numpy
+
+
+class BufferPool:
+    """
+    A pool of preallocated frame buffers, recycled rather than reallocated each frame. Buffers are reference counted:
+    acquire() hands out a buffer held once, retain() adds a holder, and release() returns the buffer to the pool once
+    every holder has released it. Intended for use within a single pipeline process.
+    """
+
+    def __init__(self, max_free_per_shape=4):
+        self._free = defaultdict(list)
+        self._references = {}
+        self._max_free_per_shape = max_free_per_shape
+        self.allocations = 0  # total buffers ever allocated, for measuring steady-state churn
+
+    def acquire(self, shape, dtype='uint8'):
+        """ Returns a buffer of the given shape and dtype, reusing a free one where possible. Contents are stale. """
+        key = (tuple(shape), numpy.dtype(dtype).str)
+        if self._free[key]:
+            buffer = self._free[key].pop()
+        else:
+            buffer = numpy.empty(shape, dtype=dtype)
+            self.allocations += 1
+
+        self._references[id(buffer)] = 1
+        return buffer
+
+    def retain(self, buffer):
+        """ Registers an additional holder of the buffer. Buffers that did not come from this pool are ignored. """
+        if id(buffer) in self._references:
+            self._references[id(buffer)] += 1
+        return buffer
+
+    def release(self, buffer):
+        """ Drops one holder of the buffer, returning it to the pool when no holders remain. Buffers that did not come
+            from this pool are ignored, so frames of mixed origin can be released without checking.
+        """
+        if buffer is None or id(buffer) not in self._references:
+            return
+
+        self._references[id(buffer)] -= 1
+        if self._references[id(buffer)] == 0:
+            del self._references[id(buffer)]
+            free = self._free[(buffer.shape, buffer.dtype.str)]
+            if len(free) < self._max_free_per_shape:
+                free.append(buffer)
+
+
+def resize_into(frame, dimensions, pool, interpolation=None):
+    """ Resizes a frame to (width, height) into a buffer from the pool via cv2.resize's dst argument. The caller
+        must release the returned buffer.
+    """
+    import cv2
+    buffer = pool.acquire((dimensions[1], dimensions[0]) + frame.shape[2:], frame.dtype)
+    cv2.resize(frame, dimensions, dst=buffer,
+               interpolation=cv2.INTER_AREA if interpolation is None else interpolation)
+    return buffer
+
+
+class CaptureBuffer:
+    """ Holds the destination array for cv2.VideoCapture.read, so each read decodes into the same memory. The buffer
+        is adopted from the first read, as the capture resolution is not known until then.
+    """
+
+    def __init__(self):
+        self.frame = None
+
+    def read(self, stream):
+        status, frame = stream.read(self.frame)
+        if status:
+            self.frame = frame  # identical to the previous buffer unless the resolution changed
+        return status, frame
+
+
+def benchmark(frames=9000, capture_dimensions=(1280, 720), target_dimensions=(640, 480), min_array_bytes=1024):
+    """
+    Compares per-frame allocation between the allocating and pooled capture/resize paths over a long run, using a
+    synthetic capture in place of a camera. Each path runs twice: untraced, for time per frame, then under tracemalloc,
+    counting the capture and resize calls that allocated new memory (at least min_array_bytes, i.e. a new array) and
+    the bytes they allocated.
+    """
+    import cv2, time, tracemalloc
+
+    class SyntheticCapture:
+        def __init__(self):
+            self._source = numpy.random.randint(0, 255, (capture_dimensions[1], capture_dimensions[0], 3), 'uint8')
+
+        def read(self, image=None):
+            if image is None or image.shape != self._source.shape:
+                image = numpy.empty_like(self._source)
+            numpy.copyto(image, self._source)  # stands in for the driver writing into the destination
+            return True, image
+
+    class AllocationCounter:
+        """ Calls a step and counts it as an allocation if traced memory peaked above its starting point. """
+        def __init__(self):
+            self.arrays = 0
+            self.bytes = 0
+
+        def __call__(self, function, *args, **kwargs):
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            result = function(*args, **kwargs)
+            allocated = tracemalloc.get_traced_memory()[1] - before
+            if allocated >= min_array_bytes:
+                self.arrays += 1
+                self.bytes += allocated
+            return result
+
+    def untraced(function, *args, **kwargs):
+        return function(*args, **kwargs)
+
+    def allocating(capture, step):
+        for _ in range(frames):
+            status, frame = step(capture.read)
+            step(cv2.resize, frame, target_dimensions, interpolation=cv2.INTER_AREA)
+
+    def pooled(capture, step):
+        pool, capture_buffer = BufferPool(), CaptureBuffer()
+        for _ in range(frames):
+            status, frame = step(capture_buffer.read, capture)
+            pool.release(step(resize_into, frame, target_dimensions, pool))
+
+    for name, run in (('allocating', allocating), ('pooled', pooled)):
+        start = time.perf_counter()
+        run(SyntheticCapture(), untraced)
+        elapsed = time.perf_counter() - start
+
+        counter = AllocationCounter()
+        tracemalloc.start()
+        run(SyntheticCapture(), counter)
+        tracemalloc.stop()
+
+        print('{:>10}: {:>6} arrays allocated over {} frames ({:.4f} per frame, {:.1f} kB per frame), '
+              '{:.3f} ms per frame'.format(name, counter.arrays, frames, counter.arrays / frames,
+                                           counter.bytes / frames / 1024, 1000 * elapsed / frames))
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -1,35 +1,182 @@
+import json
+import os
+import threading
+import time
+
 import sounddevice
 import cv2
 
+# Kept at the project root, so the inventory is shared whether this script is run from util/ or from main.
+DEFAULT_INVENTORY_FILENAME = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                          'device_inventory.json')
+
+
+def fourcc_to_string(fourcc):
+    """ OpenCV reports FOURCC codes as a float-packed integer; unpack it into its four characters. """
+    code = int(fourcc)
+    return ''.join(chr((code >> 8 * i) & 0xFF) for i in range(4)).strip('\x00')
+
+
+def probe_camera(device_id, capture_factory=cv2.VideoCapture, pixel_formats=('MJPG', 'YUYV')):
+    """ Opens a single camera ID and reports its negotiated resolution, fps and the pixel formats it accepts.
+        Returns None if nothing answers at that ID.
+    """
+    stream = capture_factory(device_id)
+    try:
+        if not stream.isOpened():
+            return None
+
+        status, frame = stream.read()
+        if not status or frame is None:
+            return None
+
+        height, width = frame.shape[0:2]
+        info = {'id': device_id,
+                'width': width,
+                'height': height,
+                'layers': frame.shape[2] if len(frame.shape) > 2 else 1,
+                'fps': stream.get(cv2.CAP_PROP_FPS),
+                'pixel_format': fourcc_to_string(stream.get(cv2.CAP_PROP_FOURCC)),
+                'pixel_formats': []}
+
+        # OpenCV cannot enumerate formats, so request each candidate and see whether the driver keeps it.
+        for pixel_format in pixel_formats:
+            stream.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*pixel_format))
+            if fourcc_to_string(stream.get(cv2.CAP_PROP_FOURCC)) == pixel_format:
+                info['pixel_formats'].append(pixel_format)
+
+        return info
+    finally:
+        stream.release()
 
-def get_camera_list():
-    """ Unfortunately, it seems that OpenCV does not provide a way to acquire a
-        list of active devices. There is likely a better way than iterating through
-        possible device IDs and trying each.
+
+def get_camera_list(max_id=16, timeout=3.0, workers=8, capture_factory=cv2.VideoCapture):
+    """ Unfortunately, it seems that OpenCV does not provide a way to acquire a list of active devices, so we try
+        every ID in range(max_id). Up to `workers` probes run at once, so gaps in the numbering do not end the search.
+        Each probe gets `timeout` seconds from when it starts; a probe stuck in a driver call is abandoned on a daemon
+        thread, freeing its slot for the next ID and never holding up exit. Returns a list of camera info dicts
+        sorted by ID.
     """
-    id_num = 0
-    cam_list = []
-
-    while True:
-        stream = cv2.VideoCapture(id_num)
-        if stream.isOpened():
-            # Check stream features
-            ret, frame = stream.read()
-            height, width, layers = frame.shape
-            print('Stream id:', id_num)
-            print('\tHeight: {} Width: {} Layers: {}'.format(height, width, layers))
-            print('\tStatus:', ret)
-
-            # Release and log id
-            stream.release()
-            cam_list.append(id_num)
-            id_num += 1
-        else:
-            stream.release()
-            break
-
-    return cam_list
+    pending = list(range(max_id))
+    running = {}  # device_id -> (thread, start time)
+    results = {}  # device_id -> (info, error), written by the probe threads
+
+    def probe(device_id):
+        try:
+            results[device_id] = probe_camera(device_id, capture_factory), None
+        except Exception as error:  # A misbehaving driver should not end the scan.
+            results[device_id] = None, error
+
+    cameras = []
+    while pending or running:
+        while pending and len(running) < workers:
+            device_id = pending.pop(0)
+            thread = threading.Thread(target=probe, args=(device_id,), name='probe-{}'.format(device_id), daemon=True)
+            thread.start()
+            running[device_id] = thread, time.time()
+
+        for device_id, (thread, start_time) in list(running.items()):
+            thread.join(timeout=0.01)
+            if not thread.is_alive():
+                del running[device_id]
+                info, error = results[device_id]
+                if error is not None:
+                    print('Stream id {}: probe failed ({}).'.format(device_id, error))
+                elif info is not None:
+                    cameras.append(info)
+            elif time.time() - start_time > timeout:
+                del running[device_id]
+                print('Stream id {}: probe timed out.'.format(device_id))
+
+    return sorted(cameras, key=lambda camera: camera['id'])
+
+
+def get_audio_device_list(query_devices=sounddevice.query_devices):
+    """ Returns the sounddevice device list as plain dicts, tagged with their device IDs. """
+    devices = []
+    for device_id, device in enumerate(query_devices()):
+        device = dict(device)
+        device['id'] = device_id
+        devices.append(device)
+
+    return devices
+
+
+def take_inventory(filename=DEFAULT_INVENTORY_FILENAME, query_devices=sounddevice.query_devices, **camera_args):
+    """ Probes all audio and video devices and writes the results to the given inventory file. Extra keyword
+        arguments are passed to get_camera_list (e.g. a FakeCapture factory for tests).
+    """
+    inventory = {'created': time.time(),
+                 'cameras': get_camera_list(**camera_args),
+                 'audio_devices': get_audio_device_list(query_devices)}
+
+    with open(filename, 'w') as inventory_file:
+        json.dump(inventory, inventory_file, indent=2, default=str)
+
+    return inventory
+
+
+def load_inventory(filename=DEFAULT_INVENTORY_FILENAME):
+    """ Reads a previously written inventory file. Returns None if no inventory has been taken. """
+    try:
+        with open(filename) as inventory_file:
+            return json.load(inventory_file)
+    except FileNotFoundError:
+        return None
+
+
+def missing_devices(inventory, camera_ids=(), microphone_ids=()):
+    """ Returns the (camera IDs, microphone IDs) that the inventory does not list as present. """
+    known_cameras = {camera['id'] for camera in inventory['cameras']}
+    known_microphones = {device['id'] for device in inventory['audio_devices'] if device['max_input_channels'] > 0}
+
+    return [id for id in camera_ids if id not in known_cameras], \
+           [id for id in microphone_ids if id not in known_microphones]
+
+
+class FakeCapture:
+    """ A stand-in for cv2.VideoCapture for testing without hardware. Devices are given as a dict of
+        id -> (width, height, fps); IDs not in the dict behave like an unopened capture.
+    """
+
+    def __init__(self, device_id, devices):
+        self._device = devices.get(device_id)
+        self._fourcc = cv2.VideoWriter_fourcc(*'YUYV')
+
+    def isOpened(self):
+        return self._device is not None
+
+    def read(self):
+        import numpy
+        width, height, fps = self._device
+        return True, numpy.zeros((height, width, 3), dtype='uint8')
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_FPS:
+            return float(self._device[2])
+        if prop == cv2.CAP_PROP_FOURCC:
+            return float(self._fourcc)
+        return 0.0
+
+    def set(self, prop, value):
+        if prop == cv2.CAP_PROP_FOURCC:
+            self._fourcc = int(value)
+        return True
+
+    def release(self):
+        pass
+
+    @staticmethod
+    def factory(devices):
+        """ Returns a capture_factory for get_camera_list that serves the given fake devices. """
+        return lambda device_id: FakeCapture(device_id, devices)
+
 
 if __name__ == '__main__':
+    inventory = take_inventory()
     print('Audio devices:\n', sounddevice.query_devices())
-    print('Active cameras:', get_camera_list())
+    print('Active cameras:')
+    for camera in inventory['cameras']:
+        print('\tStream id: {id} Height: {height} Width: {width} Layers: {layers} FPS: {fps} '
+              'Format: {pixel_format} Supported: {pixel_formats}'.format(**camera))
+    print('Inventory written to', DEFAULT_INVENTORY_FILENAME)
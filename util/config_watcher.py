@@ -0,0 +1,42 @@
+import logging
+import os
+import time
+
+
+class ConfigWatcher:
+    """ Watches the config file for changes, acting as the control channel for live reconfiguration. """
+
+    def __init__(self, filename, parse, check_interval=1.0):
+        """ The parse function takes a filename and returns the parsed parameters. """
+        self.filename = filename
+        self._parse = parse
+        self._check_interval = check_interval
+        self._last_check = time.time()
+        self._last_modified = self._modified_time()
+
+    def _modified_time(self):
+        try:
+            return os.stat(self.filename).st_mtime
+        except OSError:
+            return None
+
+    def poll(self):
+        """ Returns newly parsed parameters if the file has changed since the last poll, otherwise None. Checks are
+            rate limited, as poll is called from the main system loop.
+        """
+        now = time.time()
+        if now - self._last_check < self._check_interval:
+            return None
+        self._last_check = now
+
+        modified = self._modified_time()
+        if modified is None or modified == self._last_modified:
+            return None
+        self._last_modified = modified
+
+        # A half-saved or malformed file should not bring down a live meeting; keep the running configuration.
+        try:
+            return self._parse(self.filename)
+        except Exception:
+            logging.exception('Could not parse changed config file %s.', self.filename)
+            return None
@@ -0,0 +1,238 @@
+"""
+A persistent on-disk cache of per-frame feature measurements for file-mode runs. Entries are keyed by the content
+hash of the input files, the feature's parameters and the code version of the feature and of the stages feeding it
+(e.g. resampling and decoding), so a later run over the same
+recordings can replay the measurements instead of decoding and analyzing the media again.
+
+Usage:
+    python -m util.feature_cache clear [--directory DIR]
+    python -m util.feature_cache evict --max-bytes N [--directory DIR]
+"""
+import argparse
+import hashlib
+import inspect
+import json
+import os
+import sys
+import time
+import wave
+
+import numpy
+
+DEFAULT_CACHE_DIRECTORY = 'feature_cache'
+
+# Only this project's modules are versioned; library upgrades are not detected.
+_PROJECT_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def project_modules(classes):
+    """ The project modules defining the given classes, and every project module they use at module level,
+        recursively.
+    """
+    pending = [sys.modules[cls.__module__] for cls in classes]
+    modules = {}
+    while pending:
+        module = pending.pop()
+        filename = getattr(module, '__file__', None)
+        if module.__name__ in modules or not filename or \
+                not os.path.abspath(filename).startswith(_PROJECT_DIRECTORY + os.sep):
+            continue
+        modules[module.__name__] = module
+        for value in vars(module).values():
+            used = value if inspect.ismodule(value) else sys.modules.get(getattr(value, '__module__', None) or '')
+            if used is not None:
+                pending.append(used)
+    return [modules[name] for name in sorted(modules)]
+
+
+class FeatureCache:
+    """ A size-bounded directory of cached measurements. Least recently used entries are evicted first. """
+
+    def __init__(self, directory=DEFAULT_CACHE_DIRECTORY, max_bytes=2 * 1024 ** 3):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def file_hash(self, filename):
+        """ The SHA-1 of a file's contents. Hashes are remembered by path, size and modification time, so unchanged
+            files are not re-read on every run.
+        """
+        stat = os.stat(filename)
+        index_filename = os.path.join(self.directory, 'file_hashes.json')
+        try:
+            with open(index_filename) as index_file:
+                index = json.load(index_file)
+        except (OSError, ValueError):
+            index = {}
+
+        identity = '{}|{}|{}'.format(os.path.abspath(filename), stat.st_size, stat.st_mtime)
+        if identity not in index:
+            digest = hashlib.sha1()
+            with open(filename, 'rb') as media_file:
+                for chunk in iter(lambda: media_file.read(1024 ** 2), b''):
+                    digest.update(chunk)
+            index[identity] = digest.hexdigest()
+
+            with open(index_filename, 'w') as index_file:
+                json.dump(index, index_file)
+
+        return index[identity]
+
+    def key(self, feature_class, filenames, params, source_classes=()):
+        """ The cache key for a feature class run over the given input files with the given parameters. Editing the
+            feature's module, its source pipelines' modules, or any project module they use (e.g. util/resample.py)
+            changes the code version, invalidating the entries.
+        """
+        digest = hashlib.sha1()
+        for module in project_modules([feature_class] + list(source_classes)):
+            digest.update(inspect.getsource(module).encode())
+        code_version = digest.hexdigest()
+        description = json.dumps({'feature': feature_class.__name__,
+                                  'code': code_version,
+                                  'files': [self.file_hash(filename) for filename in filenames],
+                                  'params': repr(params)}, sort_keys=True)
+        return hashlib.sha1(description.encode()).hexdigest()
+
+    def load(self, key):
+        """ Returns (times, values) for the key, or None on a miss. """
+        try:
+            with numpy.load(self._path(key)) as entry:
+                times, values = entry['times'], entry['values']
+        except (OSError, KeyError, ValueError):
+            return None
+
+        os.utime(self._path(key))  # mark as recently used
+        return times, values
+
+    def store(self, key, times, values):
+        """ Saves measurements under the key, then evicts old entries to stay within the size bound. """
+        temporary_path = self._path(key) + '.tmp.npz'  # written fully before replacing, so readers never see a partial
+        numpy.savez(temporary_path, times=numpy.asarray(times), values=numpy.asarray(values))
+        os.replace(temporary_path, self._path(key))
+        self.evict()
+
+    def invalidate(self, key):
+        """ Removes a single entry. """
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        """ Removes every entry. """
+        for entry in self._entries():
+            os.remove(entry)
+
+    def _entries(self):
+        return [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith('.npz')]
+
+    def evict(self, max_bytes=None):
+        """ Removes least recently used entries until the cache fits within max_bytes. """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        entries = sorted(self._entries(), key=os.path.getmtime)
+        total = sum(os.path.getsize(entry) for entry in entries)
+
+        while entries and total > max_bytes:
+            entry = entries.pop(0)
+            total -= os.path.getsize(entry)
+            os.remove(entry)
+
+    def track(self, feature_class, sources, params):
+        """
+        Prepares a MeasurementTrack for a feature over the given sources. Returns None if any source is not a file
+        (live streams cannot be cached). The track replays cached measurements on a hit, and records them on a miss.
+        params may also be a function returning the parameters, for parameters only found by opening the files.
+        """
+        filenames = [str(source.source_id) for source in sources]
+        if not filenames or not all(os.path.isfile(filename) for filename in filenames):
+            return None
+        if callable(params):
+            params = params()
+
+        # Only entries covering the whole input count as hits; a run stopped early must not be replayed in full.
+        upstream, pending = set(), list(sources)  # the sources and every pipeline feeding them
+        while pending:
+            source = pending.pop()
+            if type(source) not in upstream:
+                upstream.add(type(source))
+                pending += source.inputs()
+        key = self.key(feature_class, filenames, params, upstream)
+        duration = min(media_duration(filename) for filename in filenames)
+        cached = self.load(key)
+        if cached is not None and not covers(cached[0], duration):
+            self.invalidate(key)
+            cached = None
+        return MeasurementTrack(self, key, duration, cached)
+
+
+def media_duration(filename):
+    """ The duration of an audio or video file in seconds. """
+    if filename.lower().endswith('.wav'):
+        with wave.open(filename, 'rb') as stream:
+            return stream.getnframes() / stream.getframerate()
+
+    import cv2
+    stream = cv2.VideoCapture(filename)
+    duration = stream.get(cv2.CAP_PROP_FRAME_COUNT) / (stream.get(cv2.CAP_PROP_FPS) or 30.0)
+    stream.release()
+    return duration
+
+
+def covers(times, duration, tolerance=1.0):
+    """ Whether measurements taken at the given run times cover an input of the given duration. """
+    return len(times) > 0 and times[-1] >= duration - tolerance
+
+
+class MeasurementTrack:
+    """
+    Used inside a feature's process: one row of measurements (one value per source) per feature tick, timed from
+    the start of the run. When replaying, lookup() returns the row recorded at the same point in the run.
+    """
+
+    def __init__(self, cache, key, duration, cached=None):
+        self._cache = cache
+        self._key = key
+        self._duration = duration
+        self._times, self._values = cached if cached is not None else ([], [])
+        self.replaying = cached is not None
+        self._start_time = None
+
+    def elapsed(self):
+        if self._start_time is None:
+            self._start_time = time.time()
+        return time.time() - self._start_time
+
+    def lookup(self):
+        """ The cached row for the current point in the run. """
+        index = max(0, numpy.searchsorted(self._times, self.elapsed(), side='right') - 1)
+        return self._values[min(index, len(self._values) - 1)].tolist()
+
+    def record(self, row):
+        """ Appends a row of measurements for the current point in the run. """
+        if not self.replaying:
+            self._times.append(self.elapsed())
+            self._values.append(row)
+
+    def finish(self):
+        """ Stores recorded measurements if the run covered the whole input. Called once the feature's loop has
+            stopped.
+        """
+        if not self.replaying and covers(self._times, self._duration):
+            self._cache.store(self._key, numpy.array(self._times), numpy.array(self._values, dtype='float64'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Manage the feature measurement cache.')
+    parser.add_argument('command', choices=['clear', 'evict'])
+    parser.add_argument('--directory', default=DEFAULT_CACHE_DIRECTORY)
+    parser.add_argument('--max-bytes', type=int, default=0)
+    args = parser.parse_args()
+
+    cache = FeatureCache(args.directory)
+    if args.command == 'clear':
+        cache.clear()
+    else:
+        cache.evict(args.max_bytes)
@@ -0,0 +1,145 @@
+import logging
+import time
+
+
+class LoadMonitor:
+    """
+    Measures the scheduler loop of a single process, reporting its load to a shared control dict and reading back
+    the governor's load level. Installed via util.schedule.set_tick_observer, so every periodic loop is measured
+    without changes to the pipeline functions themselves.
+    """
+
+    def __init__(self, control, shed_level=None, shed_interval_scale=2.0, report_interval=0.5, smoothing=0.2):
+        """ A process with shed_level None is never degraded; otherwise it sheds work at governor levels at or above
+            its shed_level.
+        """
+        self._control = control
+        self._shed_level = shed_level
+        self._shed_interval_scale = shed_interval_scale
+        self._report_interval = report_interval
+        self._smoothing = smoothing
+
+        self.load = 0.0  # smoothed fraction of each tick interval spent working
+        self.overruns = 0
+        self.level = 0  # the governor's load level, as last read
+        self._last_report = time.time()
+
+    @property
+    def shedding(self):
+        return self._shed_level is not None and self.level >= self._shed_level
+
+    @property
+    def interval_scale(self):
+        """ The factor by which loop intervals are stretched while shedding load. """
+        return self._shed_interval_scale if self.shedding else 1.0
+
+    def member(self, shed_level):
+        """ A monitor for one member of a fused process, shedding at its own level (see MemberLoadMonitor). """
+        return MemberLoadMonitor(self, shed_level)
+
+    def tick(self, interval, duration):
+        """ Called after each loop action with the nominal interval and the time the action took. """
+        self.measure(interval * self.interval_scale, duration)
+
+    def measure(self, interval, duration):
+        """ Accounts for a loop action that took duration of its (possibly stretched) interval. """
+        self.load += self._smoothing * (duration / interval - self.load)
+        if duration > interval:
+            self.overruns += 1
+
+        # The control dict is shared across processes, so only touch it a few times per second.
+        now = time.time()
+        if now - self._last_report >= self._report_interval:
+            self._last_report = now
+            self._control['load'] = self.load
+            self._control['overruns'] = self.overruns
+            self.level = self._control.get('level', 0)
+
+
+class MemberLoadMonitor:
+    """
+    The tick observer of one member thread of a fused process. Load is measured and reported for the process as a
+    whole, but each member sheds work at its own level, so fusing a feature with a display still drops the feature's
+    rate first and the display's last, and members that must never be degraded are not.
+    """
+
+    def __init__(self, process_monitor, shed_level):
+        self._process_monitor = process_monitor
+        self._shed_level = shed_level
+
+    @property
+    def shedding(self):
+        return self._shed_level is not None and self._process_monitor.level >= self._shed_level
+
+    @property
+    def interval_scale(self):
+        return self._process_monitor._shed_interval_scale if self.shedding else 1.0
+
+    def tick(self, interval, duration):
+        self._process_monitor.measure(interval * self.interval_scale, duration)
+
+
+class LoadGovernor:
+    """
+    Watches loop timing across all pipelines and degrades work in a defined order as the system falls behind:
+        level 1 - feature analysis runs at a reduced rate
+        level 2 - the tiled preview drops its rate and resolution
+        level 3 - the program display drops its rate
+    Program audio, the recording and the inputs feeding them have no shed level and are never degraded. Quality is
+    restored one level at a time once headroom returns.
+    """
+    max_level = 3
+
+    def __init__(self, high_load=0.9, low_load=0.5, raise_after=2, restore_after=10, check_interval=0.5):
+        """ Levels rise after raise_after consecutive overloaded checks, and fall after restore_after consecutive checks
+            with headroom. Hysteresis between the two load thresholds keeps the level from oscillating.
+        """
+        self.high_load = high_load
+        self.low_load = low_load
+        self.raise_after = raise_after
+        self.restore_after = restore_after
+        self.check_interval = check_interval
+
+        self.level = 0
+        self._overloaded_checks = 0
+        self._headroom_checks = 0
+        self._last_check = time.time()
+        self._last_overruns = {}
+
+        # The main loop is measured like any pipeline, through a local control dict.
+        self.main_monitor = LoadMonitor(control={})
+
+    def update(self, processes):
+        """ Checks pipeline loads and adjusts the load level. Called from the main loop. """
+        now = time.time()
+        if now - self._last_check < self.check_interval:
+            return
+        self._last_check = now
+
+        reports = {process.id: process.load_report() for process in processes}
+        reports['main'] = {'load': self.main_monitor.load, 'overruns': self.main_monitor.overruns}
+
+        # A process is overloaded if its loop is near capacity or it overran since the last check.
+        overloaded = []
+        for process_id, report in reports.items():
+            new_overruns = report.get('overruns', 0) - self._last_overruns.get(process_id, 0)
+            self._last_overruns[process_id] = report.get('overruns', 0)
+            if report.get('load', 0.0) > self.high_load or new_overruns > 0:
+                overloaded.append(process_id)
+
+        peak_load = max((report.get('load', 0.0) for report in reports.values()), default=0.0)
+        self._overloaded_checks = self._overloaded_checks + 1 if overloaded else 0
+        self._headroom_checks = self._headroom_checks + 1 if peak_load < self.low_load else 0
+
+        level = self.level
+        if self._overloaded_checks >= self.raise_after and self.level < self.max_level:
+            level, self._overloaded_checks = self.level + 1, 0
+        elif self._headroom_checks >= self.restore_after and self.level > 0:
+            level, self._headroom_checks = self.level - 1, 0
+
+        if level != self.level:
+            logging.info('Load level %d -> %d. Overloaded: %s', self.level, level, overloaded)
+            self.level = level
+
+        for process in processes:
+            process.set_load_level(self.level)
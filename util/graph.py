@@ -0,0 +1,289 @@
+"""
+Declarative description of the pipeline graph, with validation and a planner that fuses co-located stages into
+single processes.
+
+A graph is a dict with 'nodes', mapping node names to specs (a dict with a 'type' and that type's parameters), and
+'edges', a list of (producer, consumer) node name pairs. Stream selection is a 'selector' node: features and
+candidate video sources feed it, and program outputs are fed by it.
+"""
+import os
+
+SOURCE_TYPES = {'camera': 'video', 'video_file': 'video', 'microphone': 'audio', 'audio_file': 'audio'}
+FEATURE_TYPES = {'movement_feature': 'video', 'audio_feature': 'audio'}
+OUTPUT_TYPES = {'display': 'video', 'tiled_display': 'video', 'video_file_output': 'video', 'http_stream': 'video',
+                'audio_output': 'audio', 'audio_file_output': 'audio'}
+MIXER_TYPES = {'automixer': 'audio'}
+SELECTOR_TYPE = 'selector'
+
+# Outputs that open windows, dropped when running headless
+WINDOW_TYPES = {'display', 'tiled_display'}
+
+# Producer/consumer pairs that are fused automatically when the consumer reads the producer directly
+FUSIBLE_CHAINS = {('video_file', 'movement_feature')}
+
+# Program outputs (fed by the selector) of these types share a process automatically
+FUSIBLE_PROGRAM_OUTPUTS = {'display', 'video_file_output'}
+
+
+class GraphError(ValueError):
+    pass
+
+
+def producers(graph, node):
+    return [producer for producer, consumer in graph['edges'] if consumer == node]
+
+
+def consumers(graph, node):
+    return [consumer for producer, consumer in graph['edges'] if producer == node]
+
+
+def nodes_of_types(graph, types):
+    return [name for name, spec in graph['nodes'].items() if spec['type'] in types]
+
+
+def selector_node(graph):
+    return nodes_of_types(graph, [SELECTOR_TYPE])[0]
+
+
+def media(graph, node):
+    node_type = graph['nodes'][node]['type']
+    return SOURCE_TYPES.get(node_type) or FEATURE_TYPES.get(node_type) or MIXER_TYPES.get(node_type) or \
+        OUTPUT_TYPES.get(node_type)
+
+
+def validate_graph(graph):
+    """ Checks that the graph describes a runnable system, raising GraphError listing every problem found. """
+    errors = []
+    nodes = graph['nodes']
+    known_types = set(SOURCE_TYPES) | set(FEATURE_TYPES) | set(MIXER_TYPES) | set(OUTPUT_TYPES) | {SELECTOR_TYPE}
+
+    for name, spec in nodes.items():
+        if spec.get('type') not in known_types:
+            errors.append('Node {} has unknown type {}.'.format(name, spec.get('type')))
+
+    for producer, consumer in graph['edges']:
+        for node in (producer, consumer):
+            if node not in nodes:
+                errors.append('Edge ({}, {}) references unknown node {}.'.format(producer, consumer, node))
+
+    selectors = nodes_of_types(graph, [SELECTOR_TYPE])
+    if len(selectors) != 1:
+        errors.append('Expected exactly one selector node, found {}.'.format(len(selectors)))
+
+    if errors:  # the remaining checks assume well-formed nodes and edges
+        raise GraphError('Invalid pipeline graph:\n\t' + '\n\t'.join(errors))
+    selector = selectors[0]
+
+    for name, spec in nodes.items():
+        node_type, inputs, outputs = spec['type'], producers(graph, name), consumers(graph, name)
+
+        if node_type in SOURCE_TYPES:
+            if inputs:
+                errors.append('Source {} cannot have inputs.'.format(name))
+            if not outputs:
+                errors.append('Source {} is not used.'.format(name))
+
+        elif node_type in FEATURE_TYPES:
+            if not inputs or any(nodes[node]['type'] not in SOURCE_TYPES or media(graph, node) != media(graph, name)
+                                 for node in inputs):
+                errors.append('Feature {} must read from one or more {} sources.'.format(name, media(graph, name)))
+            if outputs != [selector]:
+                errors.append('Feature {} must feed only the selector.'.format(name))
+
+        elif node_type in MIXER_TYPES:
+            if not inputs or any(nodes[node]['type'] not in SOURCE_TYPES or media(graph, node) != 'audio'
+                                 for node in inputs):
+                errors.append('Mixer {} must read from one or more audio sources.'.format(name))
+            if not outputs or any(nodes[node]['type'] not in OUTPUT_TYPES for node in outputs):
+                errors.append('Mixer {} must feed audio outputs.'.format(name))
+
+        elif node_type == SELECTOR_TYPE:
+            if not nodes_of_types(graph, FEATURE_TYPES) or \
+                    any(nodes[node]['type'] not in FEATURE_TYPES and media(graph, node) != 'video' for node in inputs):
+                errors.append('The selector must be fed by features and candidate video sources.')
+            if not [node for node in inputs if nodes[node]['type'] in SOURCE_TYPES]:
+                errors.append('The selector has no candidate video sources.')
+            if any(media(graph, node) != 'video' for node in outputs):
+                errors.append('The selector can only feed video outputs.')
+
+        elif node_type in OUTPUT_TYPES:
+            if outputs:
+                errors.append('Output {} cannot have consumers.'.format(name))
+            if any(node != selector and media(graph, node) != media(graph, name) for node in inputs):
+                errors.append('Output {} must read {} sources.'.format(name, media(graph, name)))
+            if node_type == 'tiled_display' and (not inputs or selector in inputs):
+                errors.append('Tiled display {} must read from video sources.'.format(name))
+            elif node_type == 'http_stream' and (not inputs or (selector in inputs and len(inputs) > 1)):
+                errors.append('HTTP stream {} must read the selector alone, or video sources.'.format(name))
+            elif node_type not in ('tiled_display', 'http_stream') and len(inputs) != 1:
+                errors.append('Output {} must have exactly one input.'.format(name))
+
+        if node_type == 'audio_feature':
+            for audio, video in spec.get('pairs', {}).items():
+                if audio not in inputs or video not in producers(graph, selector):
+                    errors.append('Feature {} pairs {} with {}, which are not its input and a candidate video '
+                                  'source.'.format(name, audio, video))
+
+    program_audio = {producers(graph, node)[0] for node in nodes_of_types(graph, ['audio_output', 'audio_file_output'])
+                     if producers(graph, node)}
+    if len(program_audio) > 1:
+        errors.append('All audio outputs must share one program audio source, found {}.'.format(sorted(program_audio)))
+
+    if errors:
+        raise GraphError('Invalid pipeline graph:\n\t' + '\n\t'.join(errors))
+
+
+def plan_fusion(graph, fuse=(), no_fuse=(), auto_fuse=True):
+    """
+    Groups nodes into processes. Automatically, each file source is fused into the feature that analyzes it (e.g. a
+    video file with its motion analysis), and program outputs that write or show the same feed share a process.
+    Fused members still shed load at their own levels (see util.pipeline.FusedPipeline). Explicit fuse groups
+    override the automatic choices, and nodes listed in no_fuse always run alone. Returns a list of groups (lists of
+    node names), one per process; the selector runs in the main process and is not included.
+    """
+    processes = [name for name, spec in graph['nodes'].items() if spec['type'] != SELECTOR_TYPE]
+    for node in [node for group in fuse for node in group] + list(no_fuse):
+        if node not in processes:
+            raise GraphError('Cannot fuse unknown or selector node {}.'.format(node))
+
+    group_of = {node: [node] for node in processes}
+
+    def merge(first, second):
+        if group_of[first] is not group_of[second]:
+            merged = group_of[first] + group_of[second]
+            for node in merged:
+                group_of[node] = merged
+
+    fixed = set(no_fuse) | {node for group in fuse for node in group}
+    if auto_fuse:
+        for producer, consumer in graph['edges']:
+            if producer in fixed or consumer in fixed or producer not in group_of or consumer not in group_of:
+                continue
+            chain = (graph['nodes'][producer]['type'], graph['nodes'][consumer]['type'])
+            # A source is fused into at most one consumer; the first listed edge wins.
+            if chain in FUSIBLE_CHAINS and len(group_of[producer]) == 1:
+                merge(consumer, producer)
+
+        program_outputs = [node for node in consumers(graph, selector_node(graph)) if node not in fixed and
+                           graph['nodes'][node]['type'] in FUSIBLE_PROGRAM_OUTPUTS]
+        for node in program_outputs[1:]:
+            merge(program_outputs[0], node)
+
+    for group in fuse:
+        for node in group[1:]:
+            merge(group[0], node)
+
+    groups, seen = [], set()
+    for node in processes:
+        if id(group_of[node]) not in seen:
+            seen.add(id(group_of[node]))
+            groups.append(group_of[node])
+    return groups
+
+
+def describe_plan(graph, groups):
+    """ A printable process layout for a fusion plan, for dry runs. """
+    group_index = {node: index for index, group in enumerate(groups) for node in group}
+    lines = ['{} pipeline processes for {} stages (plus resamplers where sample rates differ):'.format(
+        len(groups), sum(len(group) for group in groups))]
+
+    for index, group in enumerate(groups):
+        lines.append('  Process {}: {}'.format(index + 1, ', '.join('{} [{}]'.format(node, graph['nodes'][node]['type'])
+                                                                 for node in group)))
+        for node in group:
+            for producer in producers(graph, node):
+                handoff = 'function call' if group_index.get(producer) == index else 'IPC'
+                lines.append('      {} -> {} ({})'.format(producer, node, handoff))
+
+    return '\n'.join(lines)
+
+
+def default_graph(parameters):
+    """ The graph for the standard setup described by the LIVE/FILES, SELECTOR and OUTPUT sections of the config. """
+    nodes, edges = {'selector': {'type': SELECTOR_TYPE}}, []
+
+    if parameters['MODE']['live_mode']:
+        video = ['camera-{}'.format(id) for id in parameters['LIVE']['active_camera_ids']]
+        audio = ['mic-{}'.format(id) for id in parameters['LIVE']['active_microphone_ids']]
+        nodes.update({name: {'type': 'camera', 'device_id': id,
+                             'compressed': parameters['LIVE'].get('compressed', False)}
+                      for name, id in zip(video, parameters['LIVE']['active_camera_ids'])})
+        nodes.update({name: {'type': 'microphone', 'device_id': id}
+                      for name, id in zip(audio, parameters['LIVE']['active_microphone_ids'])})
+        main_audio = 'mic-{}'.format(parameters['LIVE']['audio_input_device_id'])
+        if not parameters['AUDIO'].get('automix'):
+            nodes.setdefault(main_audio, {'type': 'microphone',
+                                          'device_id': parameters['LIVE']['audio_input_device_id']})
+        pairs = {'mic-{}'.format(audio_id): 'camera-{}'.format(video_id)
+                 for audio_id, video_id in parameters['LIVE']['microphone_camera_mapping']}
+    else:
+        video = ['video-' + os.path.basename(filename) for filename in parameters['FILES']['video_filenames']]
+        audio = ['audio-' + os.path.basename(filename) for filename in parameters['FILES']['audio_filenames']]
+        nodes.update({name: {'type': 'video_file', 'filename': filename,
+                             'compressed': parameters['FILES'].get('compressed', False)}
+                      for name, filename in zip(video, parameters['FILES']['video_filenames'])})
+        nodes.update({name: {'type': 'audio_file', 'filename': filename}
+                      for name, filename in zip(audio, parameters['FILES']['audio_filenames'])})
+        main_audio = 'main-audio'
+        if not parameters['AUDIO'].get('automix'):
+            nodes[main_audio] = {'type': 'audio_file', 'filename': parameters['FILES']['main_audio_file']}
+        pairs = dict(zip(audio, video))
+
+    # Features
+    nodes['F-Movement'] = {'type': 'movement_feature'}
+    nodes['F-Audio'] = {'type': 'audio_feature',
+                        'pairs': {mic: camera for mic, camera in pairs.items() if mic in audio and camera in video}}
+    edges += [(name, 'F-Movement') for name in video] + [(name, 'F-Audio') for name in audio]
+    edges += [('F-Movement', 'selector'), ('F-Audio', 'selector')] + [(name, 'selector') for name in video]
+
+    # Program audio is either the main audio input, or all mics mixed
+    if parameters['AUDIO'].get('automix'):
+        main_audio = 'automix'
+        nodes[main_audio] = {'type': 'automixer'}
+        edges += [(name, main_audio) for name in audio]
+
+    # Outputs
+    nodes['preview'] = {'type': 'tiled_display', 'title': 'Input Streams'}
+    nodes['program'] = {'type': 'display', 'title': 'Main Output'}
+    nodes['speaker'] = {'type': 'audio_output', 'device_id': parameters['OUTPUT_AUDIO']['audio_output_device_id']}
+    edges += [(name, 'preview') for name in video] + [('selector', 'program'), (main_audio, 'speaker')]
+
+    if parameters['OUTPUT_VIDEO']['video_file']:
+        nodes['program-file'] = {'type': 'video_file_output', 'filename': parameters['OUTPUT_VIDEO']['video_filename']}
+        edges.append(('selector', 'program-file'))
+
+    http = parameters.get('OUTPUT_HTTP', {})
+    if http.get('enabled'):
+        stream_settings = {'host': http.get('host', '127.0.0.1'), 'renditions': http['renditions'],
+                           'quality': http['quality']}
+        nodes['program-http'] = dict(type='http_stream', title='Main Output', port=http['program_port'],
+                                     **stream_settings)
+        nodes['preview-http'] = dict(type='http_stream', title='Input Streams', port=http['preview_port'],
+                                     **stream_settings)
+        edges += [('selector', 'program-http')] + [(name, 'preview-http') for name in video]
+
+    if parameters['OUTPUT_AUDIO']['audio_file']:
+        nodes['audio-file'] = {'type': 'audio_file_output', 'filename': parameters['OUTPUT_AUDIO']['audio_filename']}
+        edges.append((main_audio, 'audio-file'))
+
+    return {'nodes': nodes, 'edges': edges}
+
+
+def without_windows(graph):
+    """ The graph with its window outputs removed, for hosts without a display. """
+    windows = set(nodes_of_types(graph, WINDOW_TYPES))
+    return {'nodes': {name: spec for name, spec in graph['nodes'].items() if name not in windows},
+            'edges': [(producer, consumer) for producer, consumer in graph['edges'] if consumer not in windows]}
+
+
+def config_graph(parameters):
+    """ The graph given in the GRAPH section of the config, or the default graph if none is given. In headless mode,
+        window outputs are left out.
+    """
+    graph_parameters = parameters.get('GRAPH', {})
+    if graph_parameters.get('nodes'):
+        graph = {'nodes': graph_parameters['nodes'], 'edges': [tuple(edge) for edge in graph_parameters['edges']]}
+    else:
+        graph = default_graph(parameters)
+
+    return without_windows(graph) if parameters['MODE'].get('headless') else graph
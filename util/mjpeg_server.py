@@ -0,0 +1,210 @@
+"""
+Serves encoded video frames over HTTP as MJPEG (multipart/x-mixed-replace), which browsers, VLC and ffplay can view.
+Frames are published once per rendition and shared by every connected client. Each client is served by its own
+thread, which always sends the newest frame: a slow client skips the frames published while it was still sending,
+and never holds up the publisher or other clients.
+
+Usage (self-test against local clients, one of them deliberately slow):
+    python -m util.mjpeg_server
+"""
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BOUNDARY = 'frame'
+
+
+class FrameBroadcaster:
+    """ The newest encoded frame of one rendition. Clients wait for a newer frame than the one they last sent. """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._frame = None
+        self._sequence = 0
+        self._closed = False
+        self.clients = 0
+        self.sent = 0  # frames sent to clients, for measuring drops
+
+    def publish(self, frame):
+        with self._condition:
+            self._frame = frame
+            self._sequence += 1
+            self._condition.notify_all()
+
+    def next_frame(self, last_sequence, timeout=1.0):
+        """ Returns (sequence, frame) once a frame newer than last_sequence is published, or (None, None) on timeout
+            or once closed.
+        """
+        def available():
+            return self._frame is not None and self._sequence != last_sequence
+
+        with self._condition:
+            self._condition.wait_for(lambda: available() or self._closed, timeout)
+            if self._closed or not available():
+                return None, None
+            return self._sequence, self._frame
+
+    def connect(self):
+        with self._condition:
+            self.clients += 1
+
+    def disconnect(self):
+        with self._condition:
+            self.clients -= 1
+
+    def count_sent(self):
+        """ Records a frame sent to a client. Called from every client's thread. """
+        with self._condition:
+            self.sent += 1
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+
+class MJPEGServer:
+    """
+    An HTTP server with one broadcaster per rendition. Each rendition is served at /<rendition>.mjpg as a stream and at
+    /<rendition>.jpg as a single snapshot. The server runs on daemon threads; publish() never blocks on clients.
+    """
+
+    def __init__(self, port, renditions, host='127.0.0.1', send_timeout=5.0):
+        """ Serves on this machine only by default; a host of '' serves every interface. There is no authentication,
+            so only do so on a trusted network.
+        """
+        self.broadcasters = {rendition: FrameBroadcaster() for rendition in renditions}
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            timeout = send_timeout  # clients that stop reading entirely are disconnected
+
+            def do_GET(self):
+                name, _, extension = self.path.lstrip('/').partition('.')
+                if name not in server.broadcasters or extension not in ('mjpg', 'jpg'):
+                    self.send_error(404, 'Available: ' + ', '.join('/{}.mjpg'.format(name)
+                                                                   for name in server.broadcasters))
+                    return
+
+                broadcaster = server.broadcasters[name]
+                broadcaster.connect()
+                try:
+                    if extension == 'jpg':
+                        self._send_snapshot(broadcaster)
+                    else:
+                        self._send_stream(broadcaster)
+                except (ConnectionError, TimeoutError):
+                    pass  # client went away or stalled
+                finally:
+                    broadcaster.disconnect()
+
+            def _send_snapshot(self, broadcaster):
+                sequence, frame = broadcaster.next_frame(None)
+                if frame is None:
+                    self.send_error(503, 'No frame available yet')
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'image/jpeg')
+                self.send_header('Content-Length', str(len(frame)))
+                self.end_headers()
+                self.wfile.write(frame)
+
+            def _send_stream(self, broadcaster):
+                self.send_response(200)
+                self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=' + BOUNDARY)
+                self.send_header('Cache-Control', 'no-cache')
+                self.end_headers()
+
+                sequence = None
+                while not server.stopped:
+                    new_sequence, frame = broadcaster.next_frame(sequence)
+                    if new_sequence is None:
+                        continue
+                    sequence = new_sequence
+                    self.wfile.write('--{}\r\nContent-Type: image/jpeg\r\nContent-Length: {}\r\n\r\n'.format(
+                        BOUNDARY, len(frame)).encode() + frame + b'\r\n')
+                    broadcaster.count_sent()
+
+            def log_message(self, format, *args):
+                pass  # one line per request would flood the pipeline's output
+
+        self.stopped = False
+        self._http_server = ThreadingHTTPServer((host, port), Handler)
+        self._http_server.daemon_threads = True
+        self._thread = threading.Thread(target=self._http_server.serve_forever, name='mjpeg-server', daemon=True)
+        self._thread.start()
+
+    @property
+    def port(self):
+        return self._http_server.server_address[1]
+
+    def clients(self, rendition):
+        return self.broadcasters[rendition].clients
+
+    def sent(self, rendition):
+        """ The number of frames of a rendition sent to clients so far, across all clients. """
+        return self.broadcasters[rendition].sent
+
+    def publish(self, rendition, frame):
+        self.broadcasters[rendition].publish(frame)
+
+    def close(self):
+        self.stopped = True
+        for broadcaster in self.broadcasters.values():
+            broadcaster.close()
+        self._http_server.shutdown()
+        self._http_server.server_close()
+
+
+def self_test(seconds=3.0, frame_rate=30, client_count=4):
+    """
+    Publishes synthetic frames to a local server with several clients reading the stream, one of which reads slowly.
+    Reports frames published, and frames received by each client. Fast clients should receive nearly every frame; the
+    slow client receives fewer, without slowing publishing.
+    """
+    import socket
+
+    server = MJPEGServer(0, ['full'])
+    received = [0] * client_count
+
+    def client(index, delay):
+        with socket.create_connection(('127.0.0.1', server.port)) as connection:
+            connection.sendall(b'GET /full.mjpg HTTP/1.1\r\nHost: localhost\r\n\r\n')
+            connection.settimeout(1.0)
+            stream = connection.makefile('rb')
+            end = time.time() + seconds
+            while time.time() < end:
+                try:
+                    line = stream.readline()
+                except socket.timeout:
+                    continue
+                if line.startswith(b'Content-Length:'):
+                    stream.readline()
+                    stream.read(int(line.split(b':')[1]))
+                    received[index] += 1
+                    time.sleep(delay)
+
+    clients = [threading.Thread(target=client, args=(index, 0.2 if index == 0 else 0.0), daemon=True)
+               for index in range(client_count)]
+    for thread in clients:
+        thread.start()
+
+    published, frame = 0, bytes(50000)
+    start = time.time()
+    while time.time() - start < seconds:
+        server.publish('full', frame)
+        published += 1
+        time.sleep(1 / frame_rate)
+    publish_rate = published / (time.time() - start)
+
+    for thread in clients:
+        thread.join()
+    server.close()
+
+    print('Published {} frames ({:.1f} fps). Received per client: {} (client 0 reads slowly).'.format(
+        published, publish_rate, received))
+
+
+if __name__ == '__main__':
+    self_test()
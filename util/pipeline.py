@@ -1,6 +1,20 @@
-from multiprocessing import Process, Manager
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+from multiprocessing import Event, Process
+from multiprocessing.managers import SyncManager
 from collections import namedtuple
-from queue import Empty
+from queue import Empty, Queue
+
+import numpy
+
+from util.governor import LoadMonitor
+from util.profiler import SamplingProfiler, watch_profile_requests
+from util.schedule import create_periodic_event, set_tick_observer, set_default_halt_check, \
+    set_thread_tick_observer, tick_observer
 
 PipelineOutput = namedtuple('PipelineOutput', ['source_id', 'data'])
 
@@ -15,33 +29,115 @@ def get_all_from_queue(queue):
             return data
 
 
+def reset_inherited_signals():
+    """ Restores default SIGTERM and SIGUSR1 handling in a process forked from the main process. """
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, signal.SIG_DFL)
+
+
+def run_pipeline(pipeline_id, target_function, control, shed_level, stop_event, input_queue, output_queue, *params):
+    """ Entry point of every pipeline process. Installs load monitoring, profiling hooks and the stop token on the
+        process's scheduler loop before handing over to the pipeline's target function. Once the stop token is set,
+        the loop ends and the target function drains its input and releases its files and devices before returning.
+    """
+    # Shutdown is coordinated by the main process (see StreamSelector.close), so ctrl-c must not kill stages mid-write.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    # Handlers inherited from the main process (e.g. its SIGTERM halt request) must not outlive the fork, so that
+    # terminating a stuck stage still ends it.
+    reset_inherited_signals()
+
+    # Sampling profiler, toggled by SIGUSR1 or started from the main process via PipelineProcess.profile
+    profiler = SamplingProfiler(pipeline_id)
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, profiler.toggle)
+    watch_profile_requests(profiler, control)
+
+    # Work that can be shed also yields the CPU to work that cannot (program audio, recording, inputs).
+    if shed_level is not None and hasattr(os, 'nice'):
+        os.nice(shed_level)
+
+    set_tick_observer(LoadMonitor(control, shed_level=shed_level))
+    set_default_halt_check(stop_event.is_set)
+    target_function(input_queue, output_queue, *params)
+
+
 class PipelineProcess:
     """ This class operates as an intermediate processing point between inputs and outputs. """
 
+    # The load level at which this pipeline starts shedding work (see util.governor.LoadGovernor). None marks a
+    # pipeline that must never be degraded.
+    shed_level = None
+
     def __init__(self, pipeline_id, target_function, params, sources):
-        """ Initialize the synchronized objects and work process. """
+        """ Initialize the pipeline. The synchronized objects and work process are created when it starts, so a
+            pipeline fused into another process (see FusedPipeline) never creates its own.
+        """
         self.id = pipeline_id
-        self._process_manager = Manager()
+        self._target_function = target_function
+        self._params = list(params)
+        self._process_manager = None
+        self._fused_into = None
 
-        self._input_sources = {source.id: source for source in sources}
-        self._input_queue = self._process_manager.Queue(maxsize=0)
+        self._load_level = 0
+
+        # The stop token; set to end the work process's loop gracefully
+        self._stop_event = Event()
 
+        self._input_sources = {source.id: source for source in sources}
         self._output = []
+
+    def _setup(self):
+        """ Create the synchronized objects and work process. """
+        # A fresh stop token, in case this pipeline was stopped before
+        self._stop_event = Event()
+
+        self._process_manager = SyncManager()
+        self._process_manager.start(reset_inherited_signals)
+
+        # Shared with the work process for load reports and the governor's load level
+        self._control = self._process_manager.dict({'level': 0, 'load': 0.0, 'overruns': 0})
+
+        self._input_queue = self._process_manager.Queue(maxsize=0)
         self._output_queue = self._process_manager.Queue(maxsize=0)
 
-        self._process = Process(target=target_function,
-                                args=[self._input_queue, self._output_queue] + list(params))
+        self._process = Process(target=run_pipeline, name=self.id,
+                                args=[self.id, self._target_function, self._control, self.shed_level,
+                                      self._stop_event, self._input_queue, self._output_queue] + self._params)
+
+    @property
+    def _running(self):
+        """ Whether this pipeline has its own work process (it is started and not fused into another). """
+        return self._fused_into is None and self._process_manager is not None
 
     def set_inputs(self, sources):
         """ Overwrites the input sources. Used for changing pipeline structure live. """
         self._input_sources = {source.id: source for source in sources}
 
+    def sources(self):
+        """ The pipelines currently feeding this one. A fused pipeline is fed by the process it is fused into. """
+        if self._fused_into is not None:
+            return [self._fused_into]
+        return list(self._input_sources.values())
+
+    def inputs(self):
+        """ The pipelines this one reads from, whether it runs alone or is fused into another process. """
+        return list(self._input_sources.values())
+
     def start(self):
         """ Begin the work process. """
-        self._process.start()
+        if self._fused_into is None:
+            self._setup()
+            self._process.start()
+            # Maps process IDs to pipelines, e.g. for profiling one pipeline with SIGUSR1 (see util.profiler)
+            logging.info('Pipeline %s started as pid %d.', self.id, self._process.pid)
 
     def update(self):
         """ Update the inputs and outputs of the function. """
+        if not self._running:
+            return
+
         if self._input_sources:
             input_data = {source_id: source.read() for source_id, source in self._input_sources.items()}
             if input_data:
@@ -53,6 +149,193 @@ class PipelineProcess:
         """ Return the latest frame of data. """
         return self._output
 
-    def close(self):
-        """ End the work process. """
-        self._process.terminate()
+    def load_report(self):
+        """ The work process's latest load report: smoothed loop load and total tick overruns. """
+        return dict(self._control) if self._running else {}
+
+    def profile(self, seconds):
+        """ Runs the work process's sampling profiler for the given number of seconds. """
+        if self._running:
+            self._control['profile_until'] = time.time() + seconds
+
+    def set_load_level(self, level):
+        """ Passes the governor's load level to the work process. """
+        if self._running and level != self._load_level:
+            self._load_level = level
+            self._control['level'] = level
+
+    def stop(self):
+        """ Signal the work process to finish: drain its input, release its files and devices, and exit. """
+        self._stop_event.set()
+
+    def join(self, timeout=None):
+        """ Wait for the work process to exit. Returns whether it has. """
+        if not self._running:
+            return True
+        if self._process.pid is not None:
+            self._process.join(timeout)
+        return not self._process.is_alive()
+
+    def close(self, timeout=5.0):
+        """ End the work process, giving it up to timeout seconds to finish gracefully before terminating it. Shuts
+            down the process's Manager server, so the pipeline cannot be used afterwards.
+        """
+        if not self._running:
+            return
+
+        self.stop()
+        if not self.join(timeout) and self._process.pid is not None:
+            # Terminate a stage that did not finish in time, then kill it if it does not respond to that either.
+            self._process.terminate()
+            if not self.join(1.0):
+                self._process.kill()
+                self._process.join(1.0)
+        self._process_manager.shutdown()
+        self._process_manager = None
+
+
+class _HandoffQueue:
+    """
+    The output queue given to a member of a FusedPipeline. A put hands the item directly to the member's consumers in
+    the same process, and to the main process only if something outside the fused process reads it. Producers may
+    reuse their buffers once put returns (as with serializing queues), so arrays are copied on handoff.
+    """
+
+    def __init__(self, member_id, consumer_queues, output_queue):
+        self._member_id = member_id
+        self._consumer_queues = consumer_queues
+        self._output_queue = output_queue
+
+    def put_nowait(self, item):
+        if self._consumer_queues:
+            handoff = item.copy() if isinstance(item, numpy.ndarray) else item
+            for consumer_queue in self._consumer_queues:
+                consumer_queue.put_nowait({self._member_id: [handoff]})
+
+        if self._output_queue is not None:
+            self._output_queue.put_nowait((self._member_id, item))
+
+    put = put_nowait
+
+
+class FusedPipeline(PipelineProcess):
+    """
+    Runs several pipelines in a single process, one thread per member. Data passed between members is handed over in
+    memory rather than through the main process, and members keep their own identities: other pipelines read from
+    and rewire them exactly as if they ran separately. Each member thread also sheds load at its member's own level;
+    the process itself has no shed level.
+    """
+
+    def __init__(self, members, external_outputs=None, drain_timeout=5.0):
+        """ external_outputs lists the IDs of members read by pipelines outside this process (default: all). Once
+            stopped, members are given drain_timeout seconds in total to finish before the process exits regardless.
+        """
+        self.members = list(members)
+        self._members_by_id = {member.id: member for member in self.members}
+
+        internal_consumers = {member.id: [consumer.id for consumer in self.members
+                                          if member.id in consumer._input_sources] for member in self.members}
+        if external_outputs is None:
+            external_outputs = list(self._members_by_id)
+
+        super().__init__(pipeline_id='FP-' + '+'.join(member.id for member in self.members),
+                         target_function=FusedPipeline.run_members,
+                         params=([(member.id, member._target_function, member._params, member.shed_level)
+                                  for member in self.members],
+                                 internal_consumers, list(external_outputs), drain_timeout),
+                         sources=[])
+
+        for member in self.members:
+            member._fused_into = self
+
+    def _external_sources(self, member):
+        return {source_id: source for source_id, source in member._input_sources.items()
+                if source_id not in self._members_by_id}
+
+    def sources(self):
+        sources = {}
+        for member in self.members:
+            sources.update(self._external_sources(member))
+        return list(sources.values())
+
+    def update(self):
+        """ Feed each member its inputs from outside the process, and hand members the outputs they produced. """
+        if not self._running:
+            return
+
+        input_data = {member.id: {source_id: source.read()
+                                  for source_id, source in self._external_sources(member).items()}
+                      for member in self.members}
+        input_data = {member_id: data for member_id, data in input_data.items() if data}
+        if input_data:
+            self._input_queue.put_nowait(input_data)
+
+        for member in self.members:
+            member._output = []
+        for member_id, item in get_all_from_queue(self._output_queue):
+            self._members_by_id[member_id]._output.append(item)
+
+    @staticmethod
+    def run_member(target_function, shed_level, *args):
+        """ Runs one member in its thread, shedding at the member's own level (see util.governor.MemberLoadMonitor).
+        """
+        process_monitor = tick_observer()
+        if process_monitor is not None:
+            set_thread_tick_observer(process_monitor.member(shed_level))
+
+        # On Linux, niceness is per thread, so shed-able members yield the CPU without slowing the others.
+        if shed_level is not None and sys.platform.startswith('linux'):
+            os.nice(shed_level)
+
+        target_function(*args)
+
+    @staticmethod
+    def run_members(input_queue, output_queue, members, internal_consumers, external_outputs, drain_timeout):
+        member_inputs = {member_id: Queue() for member_id, _, _, _ in members}
+        threads = [threading.Thread(target=FusedPipeline.run_member, name=member_id, daemon=True,
+                                    args=[target_function, shed_level, member_inputs[member_id],
+                                          _HandoffQueue(member_id,
+                                                        [member_inputs[consumer_id]
+                                                         for consumer_id in internal_consumers[member_id]],
+                                                        output_queue if member_id in external_outputs else None)]
+                                         + list(params))
+                   for member_id, target_function, params, shed_level in members]
+        for thread in threads:
+            thread.start()
+
+        def route_inputs():
+            for update_step in get_all_from_queue(input_queue):
+                for member_id, input_data in update_step.items():
+                    member_inputs[member_id].put_nowait(input_data)
+
+        scheduler = create_periodic_event(interval=1 / 60, action=route_inputs)
+        scheduler.run()
+
+        # Stopped: pass on what is left, then wait for members to drain and finalize. Member threads are daemons, so
+        # a member still stuck at the deadline does not keep the process alive.
+        route_inputs()
+        end_time = time.time() + drain_timeout
+        for thread in threads:
+            thread.join(max(0.0, end_time - time.time()))
+
+
+def close_in_stages(stages, deadline=5.0, between_stages=None):
+    """
+    Stops groups of pipelines in order (e.g. sources, then features, then outputs), so the stop propagates
+    downstream. Each stage is stopped and joined before the next, within one overall deadline; between_stages is
+    called after each stage, e.g. to forward the last data a stage produced. Pipelines still running at the deadline
+    are terminated.
+    """
+    end_time = time.time() + deadline
+
+    for stage in stages:
+        for process in stage:
+            process.stop()
+        for process in stage:
+            process.join(max(0.0, end_time - time.time()))
+        if between_stages is not None:
+            between_stages()
+
+    for stage in stages:
+        for process in stage:
+            process.close(timeout=0)
@@ -0,0 +1,145 @@
+"""
+A low-overhead sampling profiler for pipeline processes. While active, a background thread periodically samples the
+stacks of the process's other threads. On stopping, the samples are written in the folded-stack format used by
+flame graph tools (one 'root;caller;callee count' line per stack), tagged with the pipeline's ID.
+
+Usage:
+    python -m util.profiler merge [--directory DIR] [--since TIMESTAMP]
+"""
+import argparse
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+
+DEFAULT_PROFILE_DIRECTORY = 'profiles'
+
+
+def _frame_name(code):
+    return '{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+class SamplingProfiler:
+    """ Samples the stacks of every other thread in this process at a fixed interval while running. """
+
+    def __init__(self, pipeline_id, directory=DEFAULT_PROFILE_DIRECTORY, interval=0.005):
+        self.pipeline_id = pipeline_id
+        self.directory = directory
+        self.interval = interval
+        self._stacks = Counter()
+        self._thread = None
+        self._until = None
+        self._start_time = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, duration=None):
+        """ Begins sampling, for the given number of seconds or until stopped. Extends a running profile. """
+        self._until = None if duration is None else time.time() + duration
+        if self.running:
+            return
+
+        self._stacks = Counter()
+        self._start_time = time.time()
+        self._thread = threading.Thread(target=self._sample, name='profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """ Ends sampling; the sampling thread writes the profile as it exits. """
+        self._until = time.time()
+
+    def toggle(self, *signal_args):
+        """ Starts or stops sampling. Usable directly as a signal handler. """
+        if self.running:
+            self.stop()
+        else:
+            self.start()
+
+    def _sample(self):
+        own_id = threading.get_ident()
+        while self._until is None or time.time() < self._until:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_name(frame.f_code))
+                    frame = frame.f_back
+                self._stacks[';'.join([self.pipeline_id] + stack[::-1])] += 1
+            time.sleep(self.interval)
+
+        self._write()
+
+    def _write(self):
+        os.makedirs(self.directory, exist_ok=True)
+        filename = os.path.join(self.directory, '{}.{}.{}.folded'.format(re.sub(r'[^\w.-]', '_', self.pipeline_id),
+                                                                         os.getpid(), int(self._start_time)))
+        with open(filename, 'w') as profile_file:
+            for stack, count in self._stacks.most_common():
+                profile_file.write('{} {}\n'.format(stack, count))
+
+
+def watch_profile_requests(profiler, control, poll_interval=0.5):
+    """ Starts a daemon thread that starts the profiler whenever the control dict carries a future 'profile_until'
+        time, as set by PipelineProcess.profile in the main process.
+    """
+    def watch():
+        handled = None
+        while True:
+            until = control.get('profile_until')
+            if until is not None and until != handled and until > time.time():
+                handled = until
+                profiler.start(until - time.time())
+            time.sleep(poll_interval)
+
+    threading.Thread(target=watch, name='profile-watcher', daemon=True).start()
+
+
+def merge_profiles(directory=DEFAULT_PROFILE_DIRECTORY, since=0):
+    """
+    Merges every per-process profile written since the given time into one folded-stack file, with each process as a
+    root frame, plus a text summary of the busiest processes and functions. Returns the merged filename.
+    """
+    stacks = Counter()
+    for name in os.listdir(directory):
+        match = re.match(r'.+\.\d+\.(\d+)\.folded$', name)
+        if match and int(match.group(1)) >= since:
+            with open(os.path.join(directory, name)) as profile_file:
+                for line in profile_file:
+                    stack, count = line.rsplit(' ', 1)
+                    stacks[stack] += int(count)
+
+    merged_name = os.path.join(directory, 'merged-{}'.format(int(time.time())))
+    with open(merged_name + '.folded', 'w') as merged_file:
+        for stack, count in stacks.most_common():
+            merged_file.write('{} {}\n'.format(stack, count))
+
+    # Summarize samples per process, and the functions each process was in when sampled
+    process_samples, leaf_samples = Counter(), defaultdict(Counter)
+    for stack, count in stacks.items():
+        frames = stack.split(';')
+        process_samples[frames[0]] += count
+        leaf_samples[frames[0]][frames[-1]] += count
+
+    total = sum(process_samples.values()) or 1
+    with open(merged_name + '.txt', 'w') as report_file:
+        for process_id, count in process_samples.most_common():
+            report_file.write('{:6.1%}  {}\n'.format(count / total, process_id))
+            for leaf, leaf_count in leaf_samples[process_id].most_common(5):
+                report_file.write('            {:6.1%}  {}\n'.format(leaf_count / count, leaf))
+
+    return merged_name + '.folded'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Merge per-process profiles into one report.')
+    parser.add_argument('command', choices=['merge'])
+    parser.add_argument('--directory', default=DEFAULT_PROFILE_DIRECTORY)
+    parser.add_argument('--since', type=float, default=0, help='Only merge profiles started after this time.')
+    args = parser.parse_args()
+
+    print('Merged profile written to', merge_profiles(args.directory, args.since))
@@ -0,0 +1,113 @@
+"""
+Polyphase sample rate conversion for audio streams.
+
+Usage (self-test of block-wise streaming, passband gain and alias rejection):
+    python -m util.resample
+"""
+from fractions import Fraction
+
+import numpy
+
+
+def design_polyphase_filter(up, down, taps_per_phase=16, beta=8.0):
+    """
+    Designs the anti-aliasing/anti-imaging lowpass filter for resampling by up/down and splits it into its polyphase
+    components. The prototype spans taps_per_phase samples at the lower of the two rates, so its transition band
+    narrows with the cutoff whether resampling interpolates or decimates. Returns an array of shape (up, taps), where
+    row p holds the taps applied at phase p.
+    """
+    taps_per_output = -(-max(up, down) * taps_per_phase // up)  # ceil, so every phase has the same number of taps
+    length = up * taps_per_output
+    cutoff = 0.5 / max(up, down)  # cycles per sample at the upsampled rate
+
+    n = numpy.arange(length) - (length - 1) / 2.0
+    taps = 2 * cutoff * numpy.sinc(2 * cutoff * n) * numpy.kaiser(length, beta)
+    taps *= up / taps.sum()  # unity gain at DC once upsampled
+
+    # Tap p + k * up belongs to phase p, as the k-th coefficient
+    return taps.reshape(taps_per_output, up).T.astype('float32')
+
+
+class StreamingResampler:
+    """
+    Converts audio between sample rates block by block using polyphase filtering. Filter state carries across blocks,
+    so a stream can be resampled in arbitrarily sized pieces without discontinuities at block edges. All output
+    samples of a block are computed in one vectorized pass.
+    """
+
+    def __init__(self, input_rate, output_rate, taps_per_phase=16):
+        ratio = Fraction(int(output_rate), int(input_rate))
+        self.input_rate, self.output_rate = input_rate, output_rate
+        self.up, self.down = ratio.numerator, ratio.denominator
+
+        self._phases = design_polyphase_filter(self.up, self.down, taps_per_phase)
+        self._taps = numpy.arange(self._phases.shape[1])
+        self._history = None  # the last len(self._taps) - 1 input samples
+        self._next_position = 0  # position of the next output sample, in upsampled samples from the block start
+
+    def process(self, block):
+        """ Resamples the next block of a stream, shaped (samples,) or (samples, channels). Returns the output samples
+            now available, in the input's dtype.
+        """
+        block = numpy.asarray(block)
+        if self.up == self.down:
+            return block
+
+        if self._history is None:
+            self._history = numpy.zeros((len(self._taps) - 1,) + block.shape[1:], dtype='float32')
+        extended = numpy.concatenate((self._history, block.astype('float32')))
+
+        # Output n sits at upsampled position t + n * down, which draws on input sample (position // up) and filter
+        # phase (position % up). Produce every output whose newest input sample is in this block.
+        available = len(block) * self.up - self._next_position
+        count = max(0, (available - 1) // self.down + 1) if available > 0 else 0
+        positions = self._next_position + self.down * numpy.arange(count)
+
+        newest = positions // self.up + len(self._history)  # index into extended
+        window = extended[newest[:, None] - self._taps[None, :]]  # (outputs, taps[, channels])
+        output = numpy.einsum('nk...,nk->n...', window, self._phases[positions % self.up])
+
+        self._next_position += self.down * count - len(block) * self.up
+        self._history = extended[len(extended) - len(self._history):]
+
+        if numpy.issubdtype(block.dtype, numpy.integer):
+            limits = numpy.iinfo(block.dtype)
+            return numpy.clip(numpy.rint(output), limits.min, limits.max).astype(block.dtype)
+        return output.astype(block.dtype)
+
+
+def self_test(cases=((48000, 8000), (44100, 8000), (48000, 16000), (8000, 48000)), seconds=1.0, block_size=1001):
+    """
+    Checks that resampling in odd-sized blocks matches resampling in one pass, that a tone well inside the output
+    band passes at unit gain, and that tones above the output Nyquist frequency (which would alias) are attenuated
+    below -40 dB.
+    """
+    for input_rate, output_rate in cases:
+        t = numpy.arange(int(seconds * input_rate)) / input_rate
+        nyquist = min(input_rate, output_rate) / 2
+
+        whole = StreamingResampler(input_rate, output_rate).process(numpy.sin(2 * numpy.pi * 1000 * t))
+        streaming = StreamingResampler(input_rate, output_rate)
+        blocks = numpy.concatenate([streaming.process(numpy.sin(2 * numpy.pi * 1000 * t[start:start + block_size]))
+                                    for start in range(0, len(t), block_size)])
+        assert numpy.allclose(whole, blocks[:len(whole)], atol=1e-4), 'block output differs'
+
+        levels = {}
+        for tone in (0.5 * nyquist, 1.25 * nyquist, 1.5 * nyquist):
+            if tone >= input_rate / 2:
+                continue
+            output = StreamingResampler(input_rate, output_rate).process(numpy.sin(2 * numpy.pi * tone * t))
+            steady = output[len(output) // 4:]  # past the filter's start-up transient
+            levels[tone] = 20 * numpy.log10(numpy.sqrt(2 * numpy.mean(steady ** 2)) + 1e-12)
+
+        print('{} -> {} Hz: {}'.format(input_rate, output_rate, ', '.join(
+            '{:.0f} Hz at {:.1f} dB'.format(tone, level) for tone, level in levels.items())))
+        for tone, level in levels.items():
+            if tone < nyquist:
+                assert abs(level) < 0.5, 'passband tone at {:.0f} Hz has {:.1f} dB gain'.format(tone, level)
+            else:
+                assert level < -40, 'tone at {:.0f} Hz aliases at {:.1f} dB'.format(tone, level)
+
+
+if __name__ == '__main__':
+    self_test()
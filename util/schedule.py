@@ -1,25 +1,74 @@
 import sched
+import threading
 import time
 
+# Optional observer of loop timing (see util.governor.LoadMonitor), set once per process. Threads running a fused
+# pipeline (see util.pipeline.FusedPipeline) may override it with their own.
+_tick_observer = None
+_thread_observer = threading.local()
+
+# Halt check used by loops created without one; pipeline processes set this to their stop token.
+_default_halt_check = None
+
+
+def set_default_halt_check(halt_check):
+    """ Sets the halt check for periodic events in this process that do not specify their own. """
+    global _default_halt_check
+    _default_halt_check = halt_check
+
+
+def set_tick_observer(observer):
+    """ Installs an observer whose tick(interval, duration) is called after every periodic action in this process,
+        and whose interval_scale stretches the loop interval while load is being shed.
+    """
+    global _tick_observer
+    _tick_observer = observer
+
+
+def set_thread_tick_observer(observer):
+    """ Installs an observer for periodic actions run by the calling thread only, in place of the process's. """
+    _thread_observer.observer = observer
+
+
+def tick_observer():
+    """ The observer for the calling thread: its own if it installed one, otherwise the process's. """
+    return getattr(_thread_observer, 'observer', None) or _tick_observer
+
+
+def shedding():
+    """ Whether this stage has been asked to shed load. Stages can check this to degrade their own output. """
+    observer = tick_observer()
+    return observer is not None and observer.shedding
+
 
 def periodic(scheduler, interval, action, action_args=(), halt_check=None):
     """ This design pattern schedules the next scheduling event, then separately executes the desired action. The
         reason for this is that we desire an arbitrarily long series of repeated loops rather than a finite series
         of events that would be scheduled all up front.
     """
+    observer = tick_observer()
+
     # Schedule next iteration or terminate
     if (halt_check is None) or (not halt_check()):
-        scheduler.enter(delay=interval, priority=1, action=periodic,
+        delay = interval if observer is None else interval * observer.interval_scale
+        scheduler.enter(delay=delay, priority=1, action=periodic,
                         argument=(scheduler, interval, action, action_args, halt_check))
     else:
         print('Ended:', action)
         return
 
     # Perform action with specified args
+    start = time.time()
     action(*action_args)
 
+    if observer is not None:
+        observer.tick(interval, time.time() - start)
+
 
 def create_periodic_event(interval, action, action_args=(), halt_check=None):
+    if halt_check is None:
+        halt_check = _default_halt_check
+
     scheduler = sched.scheduler(time.time, time.sleep)
     periodic(scheduler=scheduler, interval=interval, action=action, action_args=action_args, halt_check=halt_check)
 
@@ -1,16 +1,16 @@
 from util.distribution import Distribution
+from util.pipeline import close_in_stages
 
 
 class StreamSelector:
     """ This class is responsible for aggregating the feature votes and changing output streams. """
 
-    def __init__(self, inputs, weighted_feature_distribution, outputs, thrash_limit=30):
+    def __init__(self, inputs, weighted_feature_distribution, outputs, thrash_limit=30, recorder=None, governor=None):
         self.inputs = inputs
         self.features = list(weighted_feature_distribution.keys())
         self.feature_weights = weighted_feature_distribution
         self.outputs = outputs
-        self._all_input_output = set(self.inputs.audio + self.inputs.video + self.inputs.main_audio +
-                                     self.features + self.outputs.audio + self.outputs.video + self.outputs.main_video)
+        self._all_input_output = self._collect_processes()
 
         self.video_input_map = {stream.id: stream for stream in inputs.video}
 
@@ -21,6 +21,12 @@ class StreamSelector:
         self.time_since_switch = 0
         self.thrash_limit = thrash_limit
 
+        # Optional VoteRecorder, logging votes and decisions for offline tuning
+        self.recorder = recorder
+
+        # Optional LoadGovernor, shedding work across all processes when loops fall behind
+        self.governor = governor
+
     def update(self):
         """
         Steps:
@@ -36,6 +42,9 @@ class StreamSelector:
         for process in self._all_input_output:
             process.update()
 
+        if self.governor is not None:
+            self.governor.update(self._all_input_output)
+
         # Read in votes. Check votes for appropriate type.
         votes = {}
         for feature in self.features:
@@ -49,6 +58,7 @@ class StreamSelector:
         # Tally votes.
         tally = sum(vote * self.feature_weights[feature] for feature, vote in votes.items() if vote is not None)
         if tally == 0:  # no votes yet (common during initialization)
+            self._record(votes)
             return
 
         # Determine max vote and adjust primary output streams
@@ -65,6 +75,81 @@ class StreamSelector:
             for video_output in self.outputs.main_video:
                 video_output.set_inputs([self.video_input_map[max_vote]])
 
+        self._record(votes)
+
+    def _record(self, votes):
+        if self.recorder is not None:
+            self.recorder.record({feature.id: vote for feature, vote in votes.items()}, self.last_selected)
+
+    def _collect_processes(self):
+        """ All processes in the system, including intermediate stages (e.g. resamplers) reachable only as sources. """
+        processes = set()
+        pending = list(self.inputs.audio + self.inputs.video + self.inputs.main_audio +
+                       self.features + self.outputs.audio + self.outputs.video + self.outputs.main_video)
+        while pending:
+            process = pending.pop()
+            if process not in processes:
+                processes.add(process)
+                pending.extend(process.sources())
+
+        return processes
+
+    def _stages(self):
+        """ Groups processes by their distance from the sources, sources first. """
+        depths = {}
+
+        def depth(process):
+            if process not in depths:
+                depths[process] = 1 + max((depth(source) for source in process.sources()), default=-1)
+            return depths[process]
+
+        stages = [[] for _ in range(1 + max((depth(process) for process in self._all_input_output), default=-1))]
+        for process in self._all_input_output:
+            stages[depths[process]].append(process)
+
+        return stages
+
+    def reconfigure(self, inputs, weighted_feature_distribution, outputs, thrash_limit=None):
+        """
+        Swaps in a new set of inputs, features and outputs while running. Processes present in both the old and new
+        configurations are left running; only those added are started and only those removed are closed.
+        """
+        old_processes = self._all_input_output
+
+        self.inputs = inputs
+        self.features = list(weighted_feature_distribution.keys())
+        self.feature_weights = weighted_feature_distribution
+        self.outputs = outputs
+        self._all_input_output = self._collect_processes()
+        self.video_input_map = {stream.id: stream for stream in inputs.video}
+
+        if thrash_limit is not None:
+            self.thrash_limit = thrash_limit
+
+        for process in old_processes - self._all_input_output:
+            process.close()
+
+        if self.started:
+            for process in self._all_input_output - old_processes:
+                process.start()
+
+        # Keep the current selection if it survived; otherwise fall back to the first stream until the next tally.
+        if self.last_selected not in self.video_input_map:
+            self.last_selected = None
+
+        selected_stream = self.video_input_map.get(self.last_selected, self.inputs.video[0])
+        for video_output in self.outputs.main_video:
+            video_output.set_inputs([selected_stream])
+
+    def processes(self):
+        """ Every process the selector runs, including intermediate stages. """
+        return set(self._all_input_output)
+
+    def profile(self, seconds):
+        """ Profiles every sub-process for the given number of seconds. """
+        for process in self._all_input_output:
+            process.profile(seconds)
+
     def start(self):
         # start all sub-processes
         for process in self._all_input_output:
@@ -72,7 +157,21 @@ class StreamSelector:
 
         self.started = True
 
-    def close(self):
-        # start all sub-processes
-        for process in self._all_input_output:
-            process.close()
+    def close(self, deadline=5.0):
+        """
+        Stops all sub-processes within the deadline: sources first, then each stage downstream of them in turn
+        (intermediate stages, features, outputs). After each stage stops, its final data is forwarded downstream, so
+        the outputs drain everything the sources produced before writing out their files.
+        """
+        stages = self._stages()
+
+        def forward():
+            # One update per process, upstream first, so every queued item is passed on exactly once.
+            for stage in stages:
+                for process in stage:
+                    process.update()
+
+        close_in_stages(stages, deadline=deadline, between_stages=forward)
+
+        if self.recorder is not None:
+            self.recorder.save()
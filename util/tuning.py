@@ -0,0 +1,151 @@
+"""
+Replays recorded feature votes through the StreamSelector tally and switching logic, sweeping feature weights and
+thrash limits across a process pool and scoring each setting against an annotated speaker track.
+
+Usage:
+    python -m util.tuning output_files/votes.npz annotations.txt --step 0.1 --thrash-limits 10 20 30 45 60
+
+The annotation file lists one speaker turn per line as '<start seconds> <end seconds> <video stream ID>'.
+"""
+import argparse
+import itertools
+import random
+from multiprocessing import Pool
+
+import numpy
+
+from util.vote_recorder import load_recording
+
+
+def tally_winners(votes, weights):
+    """
+    Vectorized version of the StreamSelector tally. Given votes (ticks, features, streams) and a weight per feature,
+    returns the winning stream index per tick, or -1 for ticks where no feature voted.
+    """
+    voted = ~numpy.isnan(votes).all(axis=2)  # (ticks, features)
+    tally = numpy.einsum('tfs,f->ts', numpy.nan_to_num(votes), numpy.asarray(weights, dtype='float32'))
+
+    winners = tally.argmax(axis=1)
+    winners[~voted.any(axis=1)] = -1
+    return winners
+
+
+def apply_switching(winners, thrash_limit):
+    """
+    Replays the StreamSelector switching logic over per-tick winners: the output only switches to a new stream once
+    more than thrash_limit ticks have passed since the last switch. Returns the selected stream index per tick.
+    """
+    selected = numpy.empty_like(winners)
+    last_selected, time_since_switch = -1, 0
+
+    for tick, winner in enumerate(winners.tolist()):
+        if winner >= 0:
+            time_since_switch += 1
+            if last_selected < 0 or (winner != last_selected and time_since_switch > thrash_limit):
+                last_selected, time_since_switch = winner, 0
+        selected[tick] = last_selected
+
+    return selected
+
+
+def replay(recording, weights, thrash_limit):
+    """ Re-runs selection over a recording with the given weights (one per recorded feature) and thrash limit. """
+    return apply_switching(tally_winners(recording['votes'], weights), thrash_limit)
+
+
+def load_annotations(filename, recording):
+    """
+    Reads a speaker track and returns the annotated stream index per recorded tick, -1 where unannotated. Stream IDs
+    not present in the recording are ignored.
+    """
+    stream_index = {stream_id: index for index, stream_id in enumerate(recording['stream_ids'].tolist())}
+    times = recording['times']
+    reference = numpy.full(len(times), -1, dtype='int32')
+
+    with open(filename) as annotation_file:
+        for line in annotation_file:
+            if not line.strip() or line.startswith('#'):
+                continue
+            start, end, stream_id = line.split(maxsplit=2)
+            if stream_id.strip() in stream_index:
+                reference[(times >= float(start)) & (times < float(end))] = stream_index[stream_id.strip()]
+
+    return reference
+
+
+def score(selected, reference):
+    """ The fraction of annotated ticks on which the selected stream matches the annotated speaker. """
+    annotated = reference >= 0
+    if not annotated.any():
+        return 0.0
+    return float((selected[annotated] == reference[annotated]).mean())
+
+
+def weight_grid(feature_count, step):
+    """ All weightings of the features on a grid over the simplex. Only relative weights matter to the tally. """
+    steps = int(round(1 / step))
+    for counts in itertools.product(range(steps + 1), repeat=feature_count - 1):
+        if sum(counts) <= steps:
+            yield tuple(count / steps for count in counts) + ((steps - sum(counts)) / steps,)
+
+
+def random_weights(feature_count, samples, seed=None):
+    """ Uniformly sampled weightings of the features over the simplex. """
+    generator = numpy.random.RandomState(seed)
+    return [tuple(weights) for weights in generator.dirichlet(numpy.ones(feature_count), size=samples).tolist()]
+
+
+# Worker state; set once per pool process to avoid sending the recording with every task.
+_worker_recording = None
+_worker_reference = None
+
+
+def _init_worker(recording, reference):
+    global _worker_recording, _worker_reference
+    _worker_recording, _worker_reference = recording, reference
+
+
+def _evaluate(setting):
+    weights, thrash_limit = setting
+    return score(replay(_worker_recording, weights, thrash_limit), _worker_reference), weights, thrash_limit
+
+
+def sweep(recording, reference, weightings, thrash_limits, processes=None):
+    """
+    Scores every combination of weighting and thrash limit across a process pool. Returns a list of
+    (score, {feature_id: weight}, thrash_limit), best first.
+    """
+    settings = list(itertools.product(weightings, thrash_limits))
+    random.shuffle(settings)  # spread expensive (long) and cheap settings evenly across workers
+
+    with Pool(processes=processes, initializer=_init_worker, initargs=(recording, reference)) as pool:
+        results = pool.map(_evaluate, settings, chunksize=max(1, len(settings) // (4 * (processes or 8))))
+
+    feature_ids = recording['feature_ids'].tolist()
+    return sorted(((result, dict(zip(feature_ids, weights)), thrash_limit)
+                   for result, weights, thrash_limit in results),
+                  key=lambda result: result[0], reverse=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Sweep selector weights and thrash limits over a vote recording.')
+    parser.add_argument('recording', help='Recording file written by VoteRecorder.')
+    parser.add_argument('annotations', help='Speaker track: lines of <start> <end> <video stream ID>.')
+    parser.add_argument('--step', type=float, default=0.1, help='Weight grid step size.')
+    parser.add_argument('--random', type=int, default=0, help='Sample this many random weightings instead of a grid.')
+    parser.add_argument('--thrash-limits', type=int, nargs='+', default=[0, 10, 20, 30, 45, 60, 90])
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--top', type=int, default=10)
+    args = parser.parse_args()
+
+    recording = load_recording(args.recording)
+    reference = load_annotations(args.annotations, recording)
+    feature_count = len(recording['feature_ids'])
+
+    weightings = random_weights(feature_count, args.random) if args.random else list(weight_grid(feature_count,
+                                                                                                 args.step))
+    results = sweep(recording, reference, weightings, args.thrash_limits, processes=args.processes)
+
+    print('Evaluated {} settings over {} ticks.'.format(len(results), len(recording['times'])))
+    for result, weights, thrash_limit in results[:args.top]:
+        print('{:.4f}  thrash_limit={:<4} weights={}'.format(result, thrash_limit, weights))
@@ -0,0 +1,60 @@
+import time
+
+import numpy
+
+
+class VoteRecorder:
+    """
+    Records every feature's vote vector and the selector's decision per tick, to be replayed by util/tuning.py.
+    The recording is saved as a compressed numpy archive with columnar arrays:
+        times       - (ticks,) seconds since recording began
+        votes       - (ticks, features, streams) float32, NaN where a feature had no new vote that tick
+        selected    - (ticks,) index of the selected stream, -1 before any selection
+        feature_ids - (features,) feature IDs, in column order
+        stream_ids  - (streams,) video stream IDs, in column order
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.feature_ids = []
+        self.stream_ids = []
+        self._start_time = time.time()
+        self._times = []
+        self._votes = []
+        self._selected = []
+
+    def _index(self, ids, id):
+        """ Columns are assigned as IDs are first seen, so sources added by live reconfiguration are recorded too. """
+        if id not in ids:
+            ids.append(id)
+        return ids.index(id)
+
+    def record(self, votes, selected):
+        """ Records one tick, given a dict of feature ID -> vote Distribution and the selected stream ID. """
+        self._times.append(time.time() - self._start_time)
+        self._votes.append([(self._index(self.feature_ids, feature_id), self._index(self.stream_ids, stream_id), value)
+                            for feature_id, vote in votes.items() if vote is not None
+                            for stream_id, value in vote.items()])
+        self._selected.append(-1 if selected is None else self._index(self.stream_ids, selected))
+
+    def save(self):
+        """ Writes all recorded ticks to file. """
+        votes = numpy.full((len(self._times), len(self.feature_ids), len(self.stream_ids)), numpy.nan, dtype='float32')
+        for tick, tick_votes in enumerate(self._votes):
+            if tick_votes:
+                features, streams, values = zip(*tick_votes)
+                votes[tick, list(features)] = 0.0  # a feature that voted has a full vector, even if sparse
+                votes[tick, list(features), list(streams)] = values
+
+        numpy.savez_compressed(self.filename,
+                               times=numpy.array(self._times, dtype='float64'),
+                               votes=votes,
+                               selected=numpy.array(self._selected, dtype='int32'),
+                               feature_ids=numpy.array(self.feature_ids, dtype=str),
+                               stream_ids=numpy.array(self.stream_ids, dtype=str))
+
+
+def load_recording(filename):
+    """ Loads a recording saved by VoteRecorder as a dict of arrays. """
+    with numpy.load(filename) as archive:
+        return {key: archive[key] for key in archive.files}